@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+'''
+Benchmarks for migratron's command paths, against generated MIGRATIONS_DIR
+trees and matching history tables in a throw-away sqlite database.
+
+    python benchmarks/bench_commands.py --sizes 1000,10000 --output results.json
+    python benchmarks/bench_commands.py --compare results.json
+
+Each case runs in a forked child process, against a fresh copy of the
+database, so that cases can't affect each other and peak memory is per case.
+The startup_* cases instead time a whole new interpreter running
+migrate --pending, including imports and Django setup; startup_pending_cold
+has no stored directory fingerprint, so it includes the full sync.
+Results are written as JSON. With --compare, exits with status code 1 if any
+case got slower by more than --threshold, or runs more queries, than in a
+previous results file.
+'''
+import json
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+TYPES = ('pre', 'post', 'delayed')
+BENCHMARK_TYPE = 'pre'
+WORDS = ('add', 'remove', 'backfill', 'index', 'column', 'user', 'account', 'message', 'cleanup', 'dedupe',
+         'organization', 'group', 'subscription', 'null', 'default', 'preferences', 'activity', 'sharing')
+
+
+def configure_django(db_path, migrations_dir):
+    from django.conf import settings
+    settings.configure(
+        DEBUG=True,  # so that connection.queries is populated
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_path}},
+        INSTALLED_APPS=('migratron',),
+        MIGRATIONS_DIR=migrations_dir,
+        MIGRATIONS_TIMEZONE='UTC')
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def create_tables():
+    from django.core.management import call_command
+    from django.db import connection
+    from migratron.models import Migration
+    from migratron.models import MigrationHistory
+    from migratron.models import MigrationSync
+    if hasattr(connection, 'schema_editor'):
+        with connection.schema_editor() as editor:
+            editor.create_model(Migration)
+            editor.create_model(MigrationHistory)
+            editor.create_model(MigrationSync)
+    else:
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def generate_tree(migrations_dir, count, seed):
+    ''' write count scripts across TYPES, with varied header and body sizes.
+    Returns {type: [(filename, meta)]}, where meta matches what metadata() parses. '''
+    rng = random.Random(seed)
+    scripts = dict((type, []) for type in TYPES)
+    for type in TYPES:
+        os.mkdir(os.path.join(migrations_dir, type))
+    for i in range(count):
+        type = TYPES[i % len(TYPES)]
+        ext = rng.choice(('.py', '.sql'))
+        slug = '_'.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6)))
+        filename = '2012%06d_%s%s' % (i, slug, ext)
+        meta = {
+            'Generated': 'Migratron',
+            'Author': 'user%s' % rng.randint(1, 50),
+            'Created': '2012-10-25 10:42',
+            'Description': ' '.join(rng.choice(WORDS) for _ in range(int(rng.expovariate(1 / 20.0)) + 1)),
+        }
+        header = '\n'.join('%s: %s' % (key, meta[key]) for key in ('Generated', 'Author', 'Created', 'Description'))
+        lines = int(rng.expovariate(1 / 30.0)) + 1
+        if ext == '.py':
+            body = '"""\n%s\n"""\n\nif __name__ == \'__main__\':\n%s\n' % (
+                header, '\n'.join('    print %s' % n for n in range(lines)))
+        else:
+            body = '/*\n%s\n*/\n%s\n' % (
+                header, '\n'.join('UPDATE table_%s SET col = %s WHERE id = %s;' % (i, n, n) for n in range(lines)))
+        with open(os.path.join(migrations_dir, type, filename), 'w') as script:
+            script.write(body)
+        meta['link'] = None
+        scripts[type].append((filename, meta))
+    return scripts
+
+
+def generate_history(scripts, run_fraction, seed):
+    ''' Migration rows for every script, with MigrationHistory for run_fraction of them '''
+    import datetime
+    from migratron.models import Migration
+    from migratron.models import MigrationHistory
+    rng = random.Random(seed)
+    start = datetime.datetime(2012, 10, 25)
+    Migration.objects.bulk_create([
+        Migration(filename=filename, type=type, meta=meta, create_date=start)
+        for type in TYPES for filename, meta in scripts[type]])
+    histories = []
+    for id, filename in Migration.objects.values_list('id', 'filename'):
+        if rng.random() >= run_fraction:
+            continue
+        for _ in range(2 if rng.random() < 0.05 else 1):  # a few were run again
+            start += datetime.timedelta(minutes=rng.randint(1, 60))
+            histories.append(MigrationHistory(
+                migration_id=id,
+                create_date=start,
+                meta=dict(runner='user%s' % rng.randint(1, 50), duration=round(rng.expovariate(1 / 5.0), 3))))
+    MigrationHistory.objects.bulk_create(histories)
+
+
+def quiet_command(**attributes):
+    from migratron.management.commands.migrate import Command
+
+    class QuietCommand(Command):
+        def console(self, message='', color=None, newline=True):
+            pass
+
+    command = QuietCommand()
+    command.type = BENCHMARK_TYPE
+    command.pager = 'cat'
+    for key, value in attributes.items():
+        setattr(command, key, value)
+    return command
+
+
+def setup_cold_sync():
+    from migratron.models import Migration
+    Migration.objects.filter(type=BENCHMARK_TYPE).delete()
+
+
+def case_sync(command):
+    command.sync_filesystem_and_db()
+
+
+def case_list(command):
+    command.list()
+
+
+def case_list_verbose(command):
+    command.verbose = True
+    command.list()
+
+
+def case_history(command):
+    command.history()
+
+
+def case_pending(command):
+    try:
+        command.is_pending()
+    except SystemExit:
+        pass
+
+
+def case_all_log_only(command):
+    command.log_only = True
+    command.run_all()
+
+
+def case_metadata(command):
+    for filename in command.get_directory_listing():
+        command.metadata(filename)
+
+
+# name, setup (not timed), case
+CASES = (
+    ('sync_filesystem_and_db', None, case_sync),
+    ('sync_filesystem_and_db_cold', setup_cold_sync, case_sync),
+    ('list', None, case_list),
+    ('list_verbose', None, case_list_verbose),
+    ('history', None, case_history),
+    ('pending', None, case_pending),
+    ('all_log_only', None, case_all_log_only),
+    ('metadata', None, case_metadata),
+)
+
+
+def measure(setup, case):
+    ''' runs in the forked child '''
+    from django.db import connection
+    from django.db import reset_queries
+    if setup:
+        setup()
+    command = quiet_command()
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull  # --history prints directly
+    reset_queries()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        case(command)
+    finally:
+        seconds = time.time() - start
+        sys.stdout = stdout
+    result = dict(
+        seconds=round(seconds, 4),
+        queries=len(connection.queries),
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        rss_growth_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before)
+    queries_log = getattr(connection, 'queries_log', None)
+    if queries_log is not None and queries_log.maxlen and len(queries_log) >= queries_log.maxlen:
+        result['queries_truncated'] = True  # Django only keeps the most recent queries
+    return result
+
+
+def run_forked(base_db, work_dir, setup, case):
+    ''' run one case in a child process, against its own copy of the database '''
+    from django.db import connection
+    case_db = os.path.join(work_dir, 'case.sqlite3')
+    shutil.copyfile(base_db, case_db)
+    connection.close()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            connection.settings_dict['NAME'] = case_db
+            result = measure(setup, case)
+        except:
+            result = dict(error=traceback.format_exc())
+        with os.fdopen(write_fd, 'w') as output:
+            json.dump(result, output)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as output:
+        result = json.load(output)
+    os.waitpid(pid, 0)
+    os.remove(case_db)
+    return result
+
+
+def pending_child(db_path, migrations_dir):
+    ''' runs in a new interpreter, for the startup_* cases; prints the number of queries and its own peak RSS '''
+    configure_django(db_path, migrations_dir)
+    from django.db import connection
+    from migratron.management.commands.migrate import Command
+    command = Command()
+    command._output = open(os.devnull, 'w')  # "There are N pending migrations" would get in the way of the JSON
+    try:
+        command.handle(action='is_pending', type=BENCHMARK_TYPE, pager='cat')
+    except SystemExit:
+        pass
+    sys.stdout.write(json.dumps(dict(
+        queries=len(connection.queries), peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+
+
+def run_startup(base_db, work_dir, migrations_dir, warm):
+    ''' time a fresh interpreter running migrate --pending; if warm, after an untimed
+    run that stores the directory fingerprint '''
+    case_db = os.path.join(work_dir, 'case.sqlite3')
+    shutil.copyfile(base_db, case_db)
+    command = [sys.executable, os.path.abspath(__file__), '--pending-child', case_db, migrations_dir]
+    try:
+        if warm:
+            subprocess.check_output(command)
+        start = time.time()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        seconds = time.time() - start
+        if process.returncode:
+            return dict(error=errors.decode('utf-8', 'replace'))
+        result = json.loads(output.decode('utf-8'))
+        result['seconds'] = round(seconds, 4)  # peak_rss_kb comes from the child itself
+        return result
+    except subprocess.CalledProcessError as e:
+        return dict(error=str(e))
+    finally:
+        os.remove(case_db)
+
+
+STARTUP_CASES = (
+    ('startup_pending_cold', False),
+    ('startup_pending', True),
+)
+
+
+def summarise(runs):
+    errors = [r for r in runs if 'error' in r]
+    if errors:
+        return errors[0]
+    result = min(runs, key=lambda r: r['seconds'])
+    result['peak_rss_kb'] = max(r['peak_rss_kb'] for r in runs)
+    return result
+
+
+def run(sizes, repeat, run_fraction, seed, cases):
+    from django.db import connection
+    work_dir = tempfile.mkdtemp(prefix='migratron-bench-')
+    migrations_dir = os.path.join(work_dir, 'migrations')
+    configure_django(os.path.join(work_dir, 'base.sqlite3'), migrations_dir)
+    results = []
+    try:
+        for size in sizes:
+            if os.path.exists(migrations_dir):
+                shutil.rmtree(migrations_dir)
+            os.mkdir(migrations_dir)
+            base_db = connection.settings_dict['NAME']
+            connection.close()
+            if os.path.exists(base_db):
+                os.remove(base_db)
+            create_tables()
+            scripts = generate_tree(migrations_dir, size, seed)
+            generate_history(scripts, run_fraction, seed)
+            for name, setup, case in CASES:
+                if cases and name not in cases:
+                    continue
+                runs = [run_forked(base_db, work_dir, setup, case) for _ in range(repeat)]
+                results.append(report_case(summarise(runs), name, size, scripts))
+            connection.close()
+            for name, warm in STARTUP_CASES:
+                if cases and name not in cases:
+                    continue
+                runs = [run_startup(base_db, work_dir, migrations_dir, warm) for _ in range(repeat)]
+                results.append(report_case(summarise(runs), name, size, scripts))
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def report_case(result, name, size, scripts):
+    result.update(case=name, scripts=size, type_scripts=len(scripts[BENCHMARK_TYPE]))
+    sys.stderr.write('%8s scripts  %-28s %s\n' % (
+        size, name, 'ERROR' if 'error' in result else '%.3fs, %s queries' % (result['seconds'], result['queries'])))
+    return result
+
+
+def compare(results, baseline, threshold):
+    ''' regressions against an earlier results file '''
+    previous = dict(((r['scripts'], r['case']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get((result['scripts'], result['case']))
+        if not before or 'error' in before:
+            continue
+        if 'error' in result:
+            regressions.append('%(case)s at %(scripts)s scripts failed' % result)
+            continue
+        # ignore noise on very fast cases
+        if result['seconds'] > before['seconds'] * threshold and result['seconds'] - before['seconds'] > 0.05:
+            regressions.append('%s at %s scripts took %.3fs, was %.3fs' % (
+                result['case'], result['scripts'], result['seconds'], before['seconds']))
+        if result['queries'] > before['queries']:
+            regressions.append('%s at %s scripts ran %s queries, was %s' % (
+                result['case'], result['scripts'], result['queries'], before['queries']))
+    return regressions
+
+
+def main():
+    if sys.argv[1:2] == ['--pending-child']:
+        return pending_child(*sys.argv[2:4])
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--sizes', default='1000,5000',
+                      help='Comma separated numbers of scripts to generate, across all types. Default: 1000,5000')
+    parser.add_option('--repeat', type='int', default=3, help='Runs per case; the fastest is kept. Default: 3')
+    parser.add_option('--run-fraction', type='float', default=0.8,
+                      help='Fraction of scripts that already have history. Default: 0.8')
+    parser.add_option('--seed', type='int', default=1, help='Random seed for the generated scripts.')
+    parser.add_option('--cases', default=None, help='Comma separated case names to run. Default: all of them')
+    parser.add_option('--output', default=None, help='Write the JSON results to a file, rather than stdout.')
+    parser.add_option('--compare', default=None, help='Results file from an earlier run, to check for regressions.')
+    parser.add_option('--threshold', type='float', default=1.5,
+                      help='With --compare, how many times slower a case can get. Default: 1.5')
+    options, args = parser.parse_args()
+
+    baseline = None
+    if options.compare:  # read it first, in case it is also the --output file
+        with open(options.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+    import django
+    results = run(
+        [int(size) for size in options.sizes.split(',')],
+        options.repeat,
+        options.run_fraction,
+        options.seed,
+        options.cases.split(',') if options.cases else None)
+    report = dict(
+        python=platform.python_version(),
+        django=django.get_version(),
+        repeat=options.repeat,
+        run_fraction=options.run_fraction,
+        seed=options.seed,
+        results=results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if baseline:
+        regressions = compare(results, baseline, options.threshold)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION: %s\n' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,6 @@ import os
 import datetime
 import re
 import sys
-from pytz import timezone
-import yaml
-from termcolor import colored
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
@@ -13,6 +10,7 @@ class MigratronCommand(BaseCommand):
 
     color = True
     _pager = None
+    _output = None  # a file-like object to write to instead of stdout
 
     def full_script_path(self, script=""):  # empty str == migrations dir
         migrations_dir = os.path.abspath(settings.MIGRATIONS_DIR)  # simplfies '../' parts
@@ -21,6 +19,7 @@ class MigratronCommand(BaseCommand):
         return os.path.join(migrations_dir, script)
 
     def _local_datetime(self, date_time=None):
+        from pytz import timezone  # imported as needed, to keep --pending fast
         if not date_time:
             date_time = datetime.datetime.now()
         utc, local = timezone('UTC'), timezone(getattr(settings, 'MIGRATIONS_TIMEZONE', 'UTC'))
@@ -32,8 +31,10 @@ class MigratronCommand(BaseCommand):
 
     def console(self, message='', color=None, newline=True):  # passing None == newline
         ''' abstracted so we can mock it out for tests '''
-        output = self._pager.stdin if self._pager else sys.stdout
-        message = colored(message, color) if message else message
+        output = self._pager.stdin if self._pager else (self._output or sys.stdout)
+        if message and color:
+            from termcolor import colored
+            message = colored(message, color)
         output.write(message + ('\n' if newline else ''))
 
     def allowed_types(self):
@@ -62,6 +63,7 @@ class MigratronCommand(BaseCommand):
 
     def metadata(self, _script):
 
+        import yaml
         script = self.full_script_path(_script)
 
         # don't just read doc string; may execute file if code is outside __main__
@@ -1,19 +1,66 @@
+import fnmatch
+import hashlib
 import os
+import re
+import signal
+import stat
 import subprocess
 import sys
+import time
 import traceback
 import StringIO
 
+from contextlib import contextmanager
 from optparse import make_option
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import transaction
 from django.template import defaultfilters
 from textwrap import TextWrapper
 from migratron.models import Migration
 from migratron.models import MigrationHistory
-from migratron.editor import raw_input_editor
+from migratron.models import MigrationSync
+from migratron.sql import can_run_on_connection
+from migratron.sql import connection_timeouts
+from migratron.sql import explain_warnings
+from migratron.sql import split_statements
+from migratron.sql import timeout_statements
 from migratron import MigratronCommand
 
 
+class MigrationTimeout(BaseException):
+    ''' not an Exception, so that "except Exception:" in a python migration doesn't swallow it '''
+
+
+def _migrate_database(job):
+    ''' run one migrate command against one database, for --all-databases.
+    Module level, so that multiprocessing can pickle it. '''
+    database, args, options = job
+    command = Command()
+    command._output = StringIO.StringIO()
+    status = 'ok'
+    try:
+        command.handle(*args, **dict(options, database=database, all_databases=False, pager='cat'))
+    except SystemExit as e:
+        if e.code:
+            status = 'failed'
+    except:
+        command.console(traceback.format_exc())
+        status = 'failed'
+    finally:
+        connections[database].close()
+    if command.failed_migrations:
+        status = 'failed'
+    return dict(
+        database=database,
+        status=status,
+        applied=command.applied,
+        failed_at=', '.join(command.failed_migrations) or (
+            str(command.current_migration) if status == 'failed' and command.current_migration else ''),
+        output=command._output.getvalue())
+
+
 class Command(MigratronCommand):
 
     help = 'Run schema and data migration scripts'
@@ -22,10 +69,31 @@ class Command(MigratronCommand):
     run_all = False
     log_only = False
     specific_migration = None
+    specific_migrations = None
     run_again = False
     verbose = False
     pager = 'less'
     continue_on_errors = False
+    export_state_file = None
+    import_state_file = None
+    merge = False
+    regex = False
+    explain = False
+    timeout = None
+    lock_timeout = None
+    statement_timeout = None
+    timed_out = False
+    database = DEFAULT_DB_ALIAS
+    all_databases = False
+    parallel = None
+    current_migration = None
+    applied = 0
+    failed_migrations = ()
+    replay_from = None
+    sql_over_connection = False  # run sql scripts on the Django connection, rather than dbshell
+    metrics = None  # MIGRATIONS_METRICS sinks, loaded on the first event
+    rows_affected = None  # by the last script, where the database tells us
+    bulk_actions = (None, 'delete_log')  # actions that accept more than one script name, or patterns
 
     handled_migratron_option_list = (
         make_option('--type',
@@ -57,7 +125,67 @@ class Command(MigratronCommand):
                     action='store_const',
                     dest='continue_on_errors',
                     const=True,
-                    help='If a migration script fails, continue to the next one.'))
+                    help='If a migration script fails, continue to the next one.'),
+        make_option('--export-state',
+                    action='store',
+                    dest='export_state_file',
+                    default=None,
+                    help='Dump all migrations and migration history, of ALL TYPES, to a file.'),
+        make_option('--import-state',
+                    action='store',
+                    dest='import_state_file',
+                    default=None,
+                    help='Load migrations and migration history from a file created by --export-state.'),
+        make_option('--merge',
+                    action='store_const',
+                    dest='merge',
+                    const=True,
+                    help='Allow --import-state into a database that already has migration history.'),
+        make_option('--regex',
+                    action='store_const',
+                    dest='regex',
+                    const=True,
+                    help='Treat script names as regular expressions, rather than exact names or shell-style wildcards.'),
+        make_option('--explain',
+                    action='store_const',
+                    dest='explain',
+                    const=True,
+                    help='With --plan, run EXPLAIN on the statements in sql scripts, and warn about full table scans and rewrites.'),
+        make_option('--timeout',
+                    action='store',
+                    dest='timeout',
+                    default=None,
+                    help='Stop any script that runs for longer than this, like "90s", "10m" or "1h". A "timeout" in the script meta-data takes precedence.'),
+        make_option('--lock-timeout',
+                    action='store',
+                    dest='lock_timeout',
+                    default=None,
+                    help='How long statements may wait for a lock, set on the database session.'),
+        make_option('--statement-timeout',
+                    action='store',
+                    dest='statement_timeout',
+                    default=None,
+                    help='How long a single statement may run, set on the database session.'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Which database to migrate, and to keep the migration history in. Defaults to "default".'),
+        make_option('--all-databases',
+                    action='store_const',
+                    dest='all_databases',
+                    const=True,
+                    help='Run the same command against every database in MIGRATIONS_DATABASES, or else DATABASES, in parallel.'),
+        make_option('--parallel',
+                    action='store',
+                    dest='parallel',
+                    default=None,
+                    help='With --all-databases, how many databases to work on at once. Defaults to MIGRATIONS_PARALLELISM, or 4.'),
+        make_option('--replay-from',
+                    action='store',
+                    dest='replay_from',
+                    default=None,
+                    help='Run every script, of ALL TYPES, that has been run on this database alias but not on --database, in the same order.'))
 
     migratron_option_list = (
         make_option('--list',
@@ -70,6 +198,11 @@ class Command(MigratronCommand):
                     dest='action',
                     const='run_all',
                     help='Run all pending migration scripts.'),
+        make_option('--plan',
+                    action='store_const',
+                    dest='action',
+                    const='plan',
+                    help='List the pending migrations in the order --all would run them, with estimated run times.'),
         make_option('--delete-log',
                     action='store_const',
                     dest='action',
@@ -108,34 +241,72 @@ class Command(MigratronCommand):
 
     option_list = MigratronCommand.option_list + handled_migratron_option_list + migratron_option_list
 
-    def get_directory_listing(self):
-        walk_dir = self.full_script_path()
+    def get_directory_listing(self, walk_dir=None):
+        walk_dir = walk_dir or self.full_script_path()
         for dirname, dirnames, filenames in os.walk(walk_dir):
             return filenames
         return []
 
     def sync_filesystem_and_db(self):
         ''' for performance, we sync the migrations/type dir on every run w/ the database '''
-        for migration in Migration.objects.filter(type=self.type):
+        for migration in Migration.objects.using(self.database).filter(type=self.type):
             if not os.path.exists(self.full_script_path(migration.filename)):
                 migration.is_deleted = True
                 migration.save()
         # TODO: md5/timestamps?
         for filename in self.get_directory_listing():
             try:
-                migration = Migration.objects.get(type=self.type, filename=filename)
+                migration = Migration.objects.using(self.database).get(type=self.type, filename=filename)
             except Migration.DoesNotExist:
                 self.console('Getting initial meta-data for %s' % filename)
                 meta = self.metadata(filename)
-                Migration(filename=filename, type=self.type, meta=meta).save()
+                Migration(filename=filename, type=self.type, meta=meta).save(using=self.database)
+
+    def sync_state(self):
+        for state in MigrationSync.objects.using(self.database).filter(type=self.type)[:1]:
+            return state
+        return None
+
+    def directory_fingerprint(self):
+        ''' names and stat signatures of the scripts; much cheaper than a sync '''
+        path = self.full_script_path()
+        if isinstance(path, unicode):  # list bytes, so any filename can be hashed
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        digest = hashlib.sha1()
+        try:
+            filenames = sorted(os.listdir(path))
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            try:
+                stats = os.stat(os.path.join(path, filename))
+            except OSError:
+                continue
+            if stat.S_ISREG(stats.st_mode):
+                digest.update('%s\0%s\0%r\n' % (filename, stats.st_size, stats.st_mtime))
+        return digest.hexdigest()
+
+    def sync_if_needed(self):
+        ''' skip the sync if nothing in the directory has changed since the last one, by
+        this command or by watchmigrations. A recent watchmigrations sync on its own isn't
+        enough: the watcher may not have caught up with a git pull yet. '''
+        state = self.sync_state()
+        fingerprint = self.directory_fingerprint()
+        if state and state.fingerprint == fingerprint:
+            return
+        self.sync_filesystem_and_db()
+        if state:
+            MigrationSync.objects.using(self.database).filter(pk=state.pk).update(fingerprint=fingerprint)
+        else:
+            MigrationSync(type=self.type, fingerprint=fingerprint).save(using=self.database)
 
     @property
     def already_run(self):
-        return Migration.objects.filter(migrationhistory__isnull=False, type=self.type).order_by('-create_date')
+        return Migration.objects.using(self.database).filter(migrationhistory__failed=False, type=self.type).order_by('-create_date')
 
     @property
     def pending(self):
-        return Migration.objects.filter(migrationhistory__isnull=True, type=self.type).order_by('-filename')
+        return Migration.objects.using(self.database).filter(type=self.type).exclude(migrationhistory__failed=False).order_by('-filename')
 
     def _list_filename(self, migration):
         ''' filename for a migration in the --list view '''
@@ -222,21 +393,106 @@ class Command(MigratronCommand):
                     notes = meta.get('notes')
                     if notes:
                         self.console(wrap.fill(notes))
+            failed_runs = migration.failed_runs
+            if failed_runs:
+                self.console()
+                for failed_run in failed_runs:
+                    failed_meta = failed_run.meta or {}
+                    self.console(lead + 'Failed: %s, %s after %s' % (
+                        self._local_datetime(failed_run.create_date),
+                        failed_meta.get('error', 'error'),
+                        self._format_duration(failed_meta.get('duration') or 0)), 'red')
 
             if meta or last_run:
                 self.console()
 
+    def is_script_pattern(self, name):
+        return self.regex or any(char in name for char in '*?[')
+
+    def resolve_migrations(self, names):
+        ''' match any number of names and patterns against a single query '''
+        migrations = list(Migration.objects.using(self.database).filter(type=self.type, is_deleted=False).order_by('-filename'))
+        matched = set()
+        for name in names:
+            if self.regex:
+                found = [m for m in migrations if re.search(name, m.filename)]
+            elif self.is_script_pattern(name):
+                found = [m for m in migrations if fnmatch.fnmatchcase(m.filename, name)]
+            else:
+                found = [m for m in migrations if m.filename == name]
+            if not found:
+                self.failfast('No such migration found: "%s".' % name)
+            matched.update(m.id for m in found)
+        return [m for m in migrations if m.id in matched]
+
+    def run_many(self, migrations):
+        if self.log_only:
+            self.log_only_many(migrations)
+        else:
+            self.run_in_order(migrations)
+
+    def log_only_many(self, migrations):
+        pending = set(self.pending.values_list('id', flat=True))
+        to_log = []
+        for migration in migrations:
+            if migration.id not in pending and not self.run_again:
+                self.console('Skipping %s, it has already been run.' % migration)
+                continue
+            self.console('Logging %s' % migration)
+            to_log.append(migration)
+        self.log_migrations(to_log)
+        self.applied += len(to_log)
+
     def run_all(self):
-        for migration in self.pending:
-            self.run(migration)
+        if self.log_only:
+            return self.log_only_many(self.pending)
+        self.run_in_order(self.pending)
+
+    def run_in_order(self, migrations, prepare=None):
+        ''' run() each migration, with run_started/run_finished events and a progress line '''
+        migrations = list(migrations)
+        self.emit('run_started', scripts=len(migrations))
+        start = time.time()
+        try:
+            for done, migration in enumerate(migrations, 1):
+                if prepare:
+                    prepare(migration)
+                self.run(migration)
+                if done < len(migrations):
+                    self.console(self._progress_line(done, len(migrations), time.time() - start))
+        finally:
+            self.emit('run_finished', scripts=len(migrations), applied=self.applied,
+                failed=len(self.failed_migrations), duration=round(time.time() - start, 3))
+            self.metrics.close()
+            self.metrics = None
+
+    def _progress_line(self, done, total, elapsed):
+        ''' the ETA assumes the remaining scripts take as long as the ones so far, on average '''
+        return 'Progress: %s of %s scripts in %s, %.1f scripts/min, about %s to go' % (
+            done, total, self._format_duration(elapsed), done * 60 / max(elapsed, 0.001),
+            self._format_duration(elapsed / done * (total - done)))
+
+    def emit(self, event, **fields):
+        ''' send an event to the sinks in MIGRATIONS_METRICS '''
+        if self.metrics is None:
+            from migratron.metrics import get_metrics
+            self.metrics = get_metrics()
+        self.metrics.emit(event, database=self.database, type=self.type, **fields)
 
     def run(self, migration):
 
+        self.current_migration = migration
         # needs to be before pending check, in case no type is passed
         script = self.full_script_path(migration.filename)
         if not os.path.exists(script):
             self.failfast('Cannot locate script "%s".' % migration)
 
+        # python scripts use the default database unless they ask for MIGRATIONS_DATABASE themselves
+        if (script.endswith('.py') and self.database != DEFAULT_DB_ALIAS and not self.log_only and
+                not (migration.meta or {}).get('multi_db')):
+            self.failfast('Cannot run %s on "%s"; python migrations must use MIGRATIONS_DATABASE, '
+                'and say so with "multi_db: true" in their meta-data.' % (migration, self.database))
+
         if migration not in self.pending and not self.run_again:
             self.failfast('That script has already been run.')
 
@@ -244,34 +500,176 @@ class Command(MigratronCommand):
         if ext not in ('.py', '.sql'):
             self.failfast('Cannot run scripts of type: "%s"' % ext)
 
+        meta = migration.meta or {}
+        duration = None
+        self.timed_out = False
         if self.log_only:
             self.console('Logging %s' % migration)
+            result = True
         else:
             self.console('Running %s' % migration)
+            self.emit('script_started', script=migration.filename)
+            self.rows_affected = None
 
-            if ext == '.py':
-                result = self.execfile(script)
-            elif ext == '.sql':
-                with open(script, 'r') as raw_sql_file:
-                    result = self.execute_sql(raw_sql_file.read())
+            lock_timeout = self._timeout(meta, 'lock_timeout')
+            statement_timeout = self._timeout(meta, 'statement_timeout')
+            start = time.time()
+            try:
+                with self.wall_clock_timeout(self._timeout(meta, 'timeout')):
+                    if ext == '.py':
+                        with connection_timeouts(connections[self.database], lock_timeout, statement_timeout):
+                            result = self.execfile(script)
+                    elif ext == '.sql':
+                        with open(script, 'r') as raw_sql_file:
+                            raw_sql = raw_sql_file.read()
+                        if meta.get('online'):
+                            with connection_timeouts(connections[self.database], lock_timeout, statement_timeout):
+                                result = self.execute_online_sql(raw_sql, meta)
+                        elif self.sql_over_connection and can_run_on_connection(raw_sql):
+                            with connection_timeouts(connections[self.database], lock_timeout, statement_timeout):
+                                result = self.execute_sql_statements(raw_sql)
+                        else:
+                            session = timeout_statements(connections[self.database].vendor, lock_timeout, statement_timeout)
+                            result = self.execute_sql(''.join(statement + ';\n' for statement in session) + raw_sql)
+            except MigrationTimeout:
+                result = False
+            duration = time.time() - start
+            if self.timed_out:
+                self.console('Timed out after %s' % self._format_duration(duration))
+                result = False
+            self.emit('script_finished', script=migration.filename, duration=round(duration, 3),
+                rows_affected=self.rows_affected, status='timeout' if self.timed_out else 'ok' if result else 'failed')
 
         if not result:
+            self.log_migration(migration, duration, failed=True, error='timeout' if self.timed_out else 'error')
+            self.failed_migrations += (migration.filename,)
             if not self.continue_on_errors:
                 self.failfast("Aborting the rest of the migrations.")
 
             self.console("Skipping migration...")
 
         if result:
-            self.log_migration(migration)
+            self.log_migration(migration, duration)
+            self.applied += 1
         else:
             self.console("Result of script: %s..skipping migration" % result)
 
+    def _recorded_durations(self):
+        ''' average recorded run time in seconds for each script extension, from one query '''
+        totals = {}
+        for history in MigrationHistory.objects.using(self.database).filter(migration__type=self.type, failed=False).select_related('migration'):
+            duration = (history.meta or {}).get('duration')
+            if duration is None:
+                continue
+            ext = os.path.splitext(history.migration.filename)[1]
+            total, count = totals.get(ext, (0.0, 0))
+            totals[ext] = (total + duration, count + 1)
+        return dict((ext, total / count) for ext, (total, count) in totals.items())
+
+    def _parse_duration(self, value):
+        ''' seconds from values like 90, "500ms", "90s", "5m" or "2h"; None if it can't tell '''
+        if isinstance(value, (int, float)):
+            return float(value)
+        match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*$', ('%s' % (value or '')).lower())
+        if match:
+            return float(match.group(1)) * {None: 1, 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+        return None
+
+    def _header_estimate(self, meta):
+        return self._parse_duration(meta.get('estimate', meta.get('Estimate')))
+
+    def _timeout(self, meta, name):
+        ''' seconds, from the script meta-data, then the command line, then settings '''
+        for value in (meta.get(name), getattr(self, name), getattr(settings, 'MIGRATIONS_' + name.upper(), None)):
+            if value is None or value == '':
+                continue
+            seconds = self._parse_duration(value)
+            if seconds is None:
+                self.failfast('Cannot understand %s "%s"; use seconds, or values like "500ms", "90s", "10m" or "1h".' % (
+                    name, value))
+            return seconds
+        return None
+
+    @contextmanager
+    def wall_clock_timeout(self, seconds):
+        ''' raise MigrationTimeout after a number of seconds. Only works in the main thread. '''
+        def timed_out(signum, frame):
+            self.timed_out = True
+            raise MigrationTimeout()
+        installed = False
+        if seconds:
+            try:
+                previous = signal.signal(signal.SIGALRM, timed_out)
+                installed = True
+            except ValueError:
+                pass
+        if installed:
+            signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            yield
+        finally:
+            if installed:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+
+    def _format_duration(self, seconds):
+        if seconds < 1:
+            return '<1s'
+        minutes, seconds = divmod(int(round(seconds)), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '%dh %02dm' % (hours, minutes)
+        if minutes:
+            return '%dm %02ds' % (minutes, seconds)
+        return '%ds' % seconds
+
+    def plan(self):
+        pending = list(self.pending)
+        if not pending:
+            self.console('There are no pending migrations')
+            return
+
+        averages = self._recorded_durations()
+        total, unknown = 0.0, 0
+        lead = ' ' * 12
+
+        self.console('Plan:')
+        for migration in pending:
+            meta = migration.meta or {}
+            estimate = self._header_estimate(meta)
+            if estimate is None:
+                estimate = averages.get(os.path.splitext(migration.filename)[1])
+            if estimate is None:
+                unknown += 1
+                self.console('%10s' % '?', newline=False)
+            else:
+                total += estimate
+                self.console('%10s' % self._format_duration(estimate), newline=False)
+            self.console('  ' + migration.filename, 'red' if migration.flagged else None)
+            for field in ('Author', 'Description'):
+                value = meta.get(field)
+                if value:
+                    self.console(lead + field + ': ' + value)
+            if self.explain and migration.filename.endswith('.sql'):
+                try:
+                    with open(self.full_script_path(migration.filename), 'r') as raw_sql_file:
+                        warnings = explain_warnings(connections[self.database], raw_sql_file.read())
+                except IOError:
+                    warnings = ['Cannot locate script']
+                for warning in warnings:
+                    self.console(lead + 'Warning: ' + warning, 'red')
+
+        message = 'Estimated total: %s' % self._format_duration(total)
+        if unknown:
+            message += ', plus %s script(s) with no estimate' % unknown
+        self.console(message)
+
     def execfile(self, filename):
         ''' abstracted so we can mock it out for tests '''
         # execute the file using the built-in execfile method, passing
         # a __name__ of __main__, so that any main function in the file will run
         try:
-            return execfile(filename, {'__name__': '__main__'})
+            return execfile(filename, {'__name__': '__main__', 'MIGRATIONS_DATABASE': self.database})
         except:  # We can get Django DoesNotExist errors.
             output = StringIO.StringIO()
             traceback.print_exc(file=output)
@@ -285,20 +683,80 @@ class Command(MigratronCommand):
         cwd = os.getcwd()
         dbshell_cmds = getattr(settings, 'MIGRATIONS_DBSHELL_CMD', 'manage.py dbshell').split(' ')
         cmd_list = [os.path.join(cwd, dbshell_cmds[0])] + dbshell_cmds[1:]
+        if self.database != DEFAULT_DB_ALIAS:
+            cmd_list += ['--database', self.database]
         dbshell = subprocess.Popen(cmd_list, cwd=cwd, stdin=subprocess.PIPE)
-        (stdout, stderr) = dbshell.communicate(raw_sql)
+        try:
+            (stdout, stderr) = dbshell.communicate(raw_sql)
+        except MigrationTimeout:
+            dbshell.kill()
+            dbshell.wait()
+            raise
         for output in (stdout, stderr):
             if output:
                 self.console(output.read())
 
         return (dbshell.returncode == 0)
 
-    def log_migration(self, migration):
+    def execute_sql_statements(self, raw_sql):
+        ''' run a sql script one statement at a time on the Django connection, in one transaction '''
+        try:
+            with transaction.atomic(using=self.database):
+                cursor = connections[self.database].cursor()
+                self.rows_affected = 0
+                for statement in split_statements(raw_sql):
+                    cursor.execute(statement)
+                    self.rows_affected += max(cursor.rowcount, 0)  # -1 for DDL
+        except:
+            output = StringIO.StringIO()
+            traceback.print_exc(file=output)
+            self.console("Error running sql\nStack trace: %s" % output.getvalue())
+            return False
+        return True
+
+    def execute_online_sql(self, raw_sql, meta):
+        ''' ALTER TABLE through a shadow table and batched copy, for scripts with "online: true" '''
+        try:
+            from migratron.online import OnlineSchemaChange
+            change = OnlineSchemaChange.from_sql(
+                connections[self.database],
+                raw_sql,
+                batch_size=meta.get('online_batch_size', getattr(settings, 'MIGRATIONS_ONLINE_BATCH_SIZE', 1000)),
+                sleep=meta.get('online_sleep', getattr(settings, 'MIGRATIONS_ONLINE_SLEEP', 0.05)),
+                log=self.console,
+                progress=lambda copied, total: self.emit('backfill_progress',
+                    script=self.current_migration.filename, table=change.table, rows_copied=copied, rows_total=total))
+            self.rows_affected = change.run()
+        except:
+            output = StringIO.StringIO()
+            traceback.print_exc(file=output)
+            self.console("Error running online migration\nStack trace: %s" % output.getvalue())
+            return False
+        return True
+
+    def log_migration(self, migration, duration=None, failed=False, error=None):
+        meta = dict(runner=os.environ.get("USER"))
+        if duration is not None:
+            meta['duration'] = round(duration, 3)  # seconds, used by --plan estimates
+        if error:
+            meta['error'] = error
         MigrationHistory(
             migration=migration,
-            meta=dict(runner=os.environ.get("USER"))).save()
+            meta=meta,
+            failed=failed).save(using=self.database)
+
+    def log_migrations(self, migrations):
+        MigrationHistory.objects.using(self.database).bulk_create([
+            MigrationHistory(migration=migration, meta=dict(runner=os.environ.get("USER")))
+            for migration in migrations])
 
     def delete_log(self):
+        if self.specific_migrations:
+            logs = MigrationHistory.objects.using(self.database).filter(migration__in=self.specific_migrations)
+            count = logs.count()
+            logs.delete()
+            self.console('Removed %s migration log(s) for %s script(s).' % (count, len(self.specific_migrations)))
+            return
         if not self.specific_migration:
             self.failfast('Must specify a specific script to delete the logs for.')
         # can delete more than one script if you ran them multiple times w/ --again
@@ -310,16 +768,17 @@ class Command(MigratronCommand):
 
     def is_pending(self):
         ''' useful for aborting hudson/jenkins/fab jobs '''
-        if self.pending:
-            self.failfast('There are %s pending migrations' % len(self.pending))
+        count = self.pending.count()
+        if count:
+            self.failfast('There are %s pending migrations' % count)
 
     def history(self):
-        migrations = [h.migration for h in MigrationHistory.objects.all().order_by('-create_date')]
+        migrations = [h.migration for h in MigrationHistory.objects.using(self.database).filter(failed=False).order_by('-create_date')]
         if self.verbose:
             self.list(do_pending=False, migrations=migrations)
         else:
             for migration in migrations:
-                print migration.filename
+                self.console(migration.filename)
 
     def info(self):
         if not self.specific_migration:
@@ -350,13 +809,169 @@ class Command(MigratronCommand):
         if not migrations:
             self.failfast('That script has not been run yet.')
         migration = migrations[0]
+        from migratron.editor import raw_input_editor
         migration.meta['notes'] = raw_input_editor(migration.meta.get('notes', ''))
         migration.save()
 
     def clear(self):
         if raw_input('Are you SURE you want to delete all migration history of ALL TYPES? [y/n] ').lower() == 'y':
-            MigrationHistory.objects.all().delete()
-            Migration.objects.all().delete()
+            MigrationHistory.objects.using(self.database).delete()
+            Migration.objects.using(self.database).delete()
+            MigrationSync.objects.using(self.database).delete()
+
+    def export_state(self):
+        histories = {}
+        for history in MigrationHistory.objects.using(self.database).order_by('create_date'):
+            histories.setdefault(history.migration_id, []).append(dict(
+                create_date=history.create_date,
+                meta=history.meta,
+                failed=history.failed))
+        state = []
+        for migration in Migration.objects.using(self.database).order_by('type', 'filename'):
+            state.append(dict(
+                type=migration.type,
+                filename=migration.filename,
+                meta=migration.meta,
+                is_deleted=migration.is_deleted,
+                flagged=migration.flagged,
+                create_date=migration.create_date,
+                history=histories.get(migration.id, [])))
+        import yaml
+        with open(self.export_state_file, 'w') as state_file:
+            yaml.dump(dict(version=1, migrations=state), state_file,
+                Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+        self.console('Exported %s migrations to %s' % (len(state), self.export_state_file))
+
+    def import_state(self):
+        import yaml
+        with open(self.import_state_file, 'r') as state_file:
+            state = yaml.load(state_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        if not isinstance(state, dict) or state.get('version') != 1:
+            self.failfast('%s is not a migratron state file.' % self.import_state_file)
+
+        # one query up front, instead of a get() per script
+        existing = dict(((type, filename), id) for id, type, filename in
+            Migration.objects.using(self.database).values_list('id', 'type', 'filename'))
+        if existing and not self.merge:
+            self.failfast('There is already migration history in the database. Use --merge to combine them, or --clear first.')
+
+        # merging reconciles against what is actually on disk; the next sync takes care of any new files
+        listings = {}
+        migrations_dir = os.path.abspath(settings.MIGRATIONS_DIR)
+        migrations = []
+        for entry in state['migrations']:
+            key = (entry['type'], entry['filename'])
+            if key in existing:
+                continue
+            is_deleted = entry['is_deleted']
+            if self.merge:
+                if entry['type'] not in listings:
+                    listings[entry['type']] = set(self.get_directory_listing(
+                        os.path.join(migrations_dir, entry['type'] or '')))
+                is_deleted = entry['filename'] not in listings[entry['type']]
+            migrations.append(Migration(
+                type=entry['type'],
+                filename=entry['filename'],
+                meta=entry['meta'],
+                is_deleted=is_deleted,
+                flagged=entry['flagged'],
+                create_date=entry['create_date']))
+
+        with transaction.atomic(using=self.database):
+            Migration.objects.using(self.database).bulk_create(migrations)
+            # bulk_create doesn't set primary keys, so look them all up again in one query
+            ids = dict(((type, filename), id) for id, type, filename in
+                Migration.objects.using(self.database).values_list('id', 'type', 'filename'))
+            already_logged = set(MigrationHistory.objects.using(self.database).values_list('migration_id', 'create_date'))
+            histories = []
+            for entry in state['migrations']:
+                migration_id = ids[(entry['type'], entry['filename'])]
+                for history in entry['history']:
+                    if (migration_id, history['create_date']) in already_logged:
+                        continue
+                    histories.append(MigrationHistory(
+                        migration_id=migration_id,
+                        meta=history['meta'],
+                        failed=history.get('failed', False),
+                        create_date=history['create_date']))
+            MigrationHistory.objects.using(self.database).bulk_create(histories)
+
+        self.console('Imported %s migrations and %s log entries from %s' % (
+            len(migrations), len(histories), self.import_state_file))
+
+    def databases(self):
+        return list(getattr(settings, 'MIGRATIONS_DATABASES', None) or sorted(settings.DATABASES.keys()))
+
+    def run_on_all_databases(self, args, options):
+        ''' fan the same command out to every database, with a bounded pool of processes '''
+        databases = self.databases()
+        processes = int(self.parallel or getattr(settings, 'MIGRATIONS_PARALLELISM', 4))
+        for connection in connections.all():
+            connection.close()  # don't share sockets with the forked workers
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(databases)))
+        results = []
+        try:
+            for result in pool.imap_unordered(_migrate_database, [(database, args, options) for database in databases]):
+                self.console('==> %s <==' % result['database'], 'red' if result['status'] != 'ok' else None)
+                self.console(result['output'], newline=False)
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.console()
+        width = max(len(database) for database in databases + ['Database'])
+        self.console('%s  %-6s  %7s  %s' % ('Database'.ljust(width), 'Status', 'Applied', 'Failed at'))
+        for result in sorted(results, key=lambda result: databases.index(result['database'])):
+            self.console('%s  %-6s  %7s  %s' % (
+                result['database'].ljust(width), result['status'], result['applied'], result['failed_at']),
+                'red' if result['status'] != 'ok' else None)
+        failed = [result for result in results if result['status'] != 'ok']
+        if failed:
+            self.failfast('%s of %s databases failed' % (len(failed), len(databases)))
+
+    def missing_from(self, database):
+        ''' migrations run on another database but not this one, in the order they were run there.
+        One query per database. '''
+        done = set(MigrationHistory.objects.using(self.database).filter(failed=False).values_list(
+            'migration__type', 'migration__filename'))
+        missing = []
+        for history in MigrationHistory.objects.using(database).filter(failed=False).select_related(
+                'migration').order_by('create_date'):
+            key = (history.migration.type, history.migration.filename)
+            if key not in done:
+                done.add(key)  # only the first run counts, if it was run --again
+                missing.append(history.migration)
+        return missing
+
+    def replay(self):
+        missing = self.missing_from(self.replay_from)
+        if not missing:
+            self.console('Database "%s" has already run everything that "%s" has.' % (self.database, self.replay_from))
+            return
+
+        migrations_dir = os.path.abspath(settings.MIGRATIONS_DIR)
+        not_found = [m for m in missing if not os.path.exists(os.path.join(migrations_dir, m.type or '', m.filename))]
+        if not_found:
+            self.failfast('Cannot locate scripts: %s' % ', '.join(
+                os.path.join(m.type or '', m.filename) for m in not_found))
+
+        # the scripts may never have been synced on this database
+        existing = dict(((m.type, m.filename), m) for m in Migration.objects.using(self.database))
+        Migration.objects.using(self.database).bulk_create([
+            Migration(type=m.type, filename=m.filename, meta=m.meta)
+            for m in missing if (m.type, m.filename) not in existing])
+        existing = dict(((m.type, m.filename), m) for m in Migration.objects.using(self.database))
+
+        self.console('Replaying %s migrations from "%s" on "%s"' % (len(missing), self.replay_from, self.database))
+        type, self.sql_over_connection = self.type, True
+        try:
+            # run() looks for scripts, and pending ones, by type
+            self.run_in_order([existing[(m.type, m.filename)] for m in missing],
+                prepare=lambda migration: setattr(self, 'type', migration.type))
+        finally:
+            self.type, self.sql_over_connection = type, False
 
     def handle(self, *args, **options):
 
@@ -365,16 +980,34 @@ class Command(MigratronCommand):
             arg = option.dest
             setattr(self, arg, options.get(arg))
         self.failfast_bad_type()
+        if self.all_databases:
+            return self.run_on_all_databases(args, options)
+        self.database = self.database or DEFAULT_DB_ALIAS
         self.specific_script_name = args[0] if args else None
         action = options.get('action', None)
-
-        self.sync_filesystem_and_db()
-
-        if self.specific_script_name:
-            self.specific_migration = Migration.objects.get(type=self.type, filename=self.specific_script_name)
-
-        if self.specific_migration and not action:
-            self.run(self.specific_migration)
+        if self.export_state_file:
+            action = 'export_state'
+        elif self.import_state_file:
+            action = 'import_state'
+        elif self.replay_from:
+            action = 'replay'
+
+        for name in ('timeout', 'lock_timeout', 'statement_timeout'):
+            self._timeout({}, name)  # fail on a bad --timeout or setting before running anything
+
+        # state files cover every type, and seeding a fresh database shouldn't parse every script first
+        if action not in ('export_state', 'import_state'):
+            self.sync_if_needed()
+
+        if action in self.bulk_actions and args and (len(args) > 1 or self.is_script_pattern(args[0])):
+            self.specific_migrations = self.resolve_migrations(args)
+        elif self.specific_script_name:
+            self.specific_migration = Migration.objects.using(self.database).get(type=self.type, filename=self.specific_script_name)
+
+        if self.specific_migrations and not action:
+            self.run_many(self.specific_migrations)
+        elif self.specific_migration and not action:
+            self.run_in_order([self.specific_migration])
         elif not action:
             self.print_help('migrate', 'help')
         else:
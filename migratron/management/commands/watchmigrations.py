@@ -0,0 +1,144 @@
+import os
+from optparse import make_option
+from django.utils import timezone
+from migratron.models import Migration
+from migratron.models import MigrationSync
+from migratron.watcher import get_watcher
+from migratron.management.commands.migrate import Command as MigrateCommand
+from migratron import MigratronCommand
+
+
+class Command(MigrateCommand):
+
+    help = 'Keep the migrations in the database in sync with MIGRATIONS_DIR as files change, so other commands can skip their own sync'
+    interval = 5
+    batch_size = 100
+    poll = False
+
+    handled_migratron_option_list = (
+        make_option('--type',
+                    action='store',
+                    dest='type',
+                    default=None,
+                    help='What type of migrations to watch. Corresponds to sub-directories under MIGRATIONS_DIR.'),
+        make_option('--database',
+                    action='store',
+                    dest='database',
+                    default=MigrateCommand.database,
+                    help='Which database to keep in sync. Defaults to "default".'),
+        make_option('--interval',
+                    action='store',
+                    dest='interval',
+                    default=5,
+                    help='Seconds between checks for changes, and between updates of the sync fingerprint. Defaults to 5.'),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    default=100,
+                    help='Most file changes to apply to the database at once. Defaults to 100.'),
+        make_option('--poll',
+                    action='store_const',
+                    dest='poll',
+                    const=True,
+                    help='Poll the directory for changes, even if inotify is available.'))
+
+    option_list = MigratronCommand.option_list + handled_migratron_option_list
+
+    def record_watermark(self, fingerprint):
+        ''' the directory fingerprint the database is now in sync with, which lets other commands skip their sync '''
+        now = timezone.now()
+        if not MigrationSync.objects.using(self.database).filter(type=self.type).update(
+                synced_at=now, fingerprint=fingerprint):
+            MigrationSync(type=self.type, synced_at=now, fingerprint=fingerprint).save(using=self.database)
+
+    def apply_changes(self, changes, report=True):
+        ''' changes is {filename: "created", "modified" or "deleted"}. Applying the same change twice is harmless. '''
+        deleted = [filename for filename, kind in changes.items() if kind == 'deleted']
+        changed = [filename for filename, kind in changes.items() if kind != 'deleted']
+        migrations = Migration.objects.using(self.database).filter(type=self.type)
+        existing = {}
+        for start in range(0, max(len(deleted), len(changed)), 500):  # SQLite allows 999 query parameters
+            if deleted[start:start + 500]:
+                migrations.filter(filename__in=deleted[start:start + 500]).update(is_deleted=True)
+            existing.update((m.filename, m) for m in migrations.filter(filename__in=changed[start:start + 500]))
+        new = []
+        for filename in changed:
+            if not os.path.isfile(self.full_script_path(filename)):  # already gone again
+                continue
+            meta = self.metadata(filename)
+            migration = existing.get(filename)
+            if migration:
+                if migration.meta != meta or migration.is_deleted:
+                    migration.meta = meta
+                    migration.is_deleted = False
+                    migration.save()
+            else:
+                new.append(Migration(filename=filename, type=self.type, meta=meta))
+        Migration.objects.using(self.database).bulk_create(new)
+        if report:
+            for filename in sorted(changes):
+                self.console('%-8s %s' % (changes[filename], filename))
+
+    def resync(self):
+        ''' re-read every script, and mark scripts that are gone as deleted. Unlike sync_filesystem_and_db
+        this picks up edits and scripts that came back, which lost events may have hidden. '''
+        changes = dict((filename, 'modified') for filename in self.get_directory_listing())
+        for filename in Migration.objects.using(self.database).filter(type=self.type, is_deleted=False).values_list(
+                'filename', flat=True):
+            changes.setdefault(filename, 'deleted')
+        self.apply_changes(changes, report=False)
+
+    def apply_events(self, events):
+        if any(kind == 'overflow' for kind, filename in events):
+            self.console('Some changes were missed, re-reading every script')
+            self.resync()
+            return
+        changes = {}
+        for kind, filename in events:  # the last event for a file wins
+            # editor swap and backup files come and go all the time
+            if not filename.startswith('.') and not filename.endswith('~'):
+                changes[filename] = kind
+        if changes:
+            self.apply_changes(changes)
+
+    def watch(self, watcher):
+        events = []
+        while True:
+            events += watcher.events(0 if events else self.interval)
+            while events and len(events) < self.batch_size:  # pick up the rest of a burst, like a git pull
+                more = watcher.events(0.1)
+                if not more:
+                    break
+                events += more
+            # fingerprint before reading any scripts; whatever changes after this is still queued in the watcher
+            fingerprint = self.directory_fingerprint()
+            self.apply_events(events)
+            events = watcher.events(0)
+            if not events:  # otherwise the fingerprint may include changes that are not applied yet
+                self.record_watermark(fingerprint)
+
+    def handle(self, *args, **options):
+
+        for option in self.handled_migratron_option_list:
+            setattr(self, option.dest, options.get(option.dest))
+        self.interval = float(self.interval or 5)
+        self.batch_size = int(self.batch_size or 100)
+        self.failfast_bad_type()
+
+        path = self.full_script_path()
+        if not os.path.isdir(path):
+            self.failfast('Cannot locate migrations directory "%s".' % path)
+
+        # start watching before the first sync, so nothing that changes during it is missed.
+        # Those events are replayed by watch(), and applying them again is harmless.
+        watcher = get_watcher(path, self.poll)
+        try:
+            fingerprint = self.directory_fingerprint()
+            self.sync_filesystem_and_db()
+            self.record_watermark(fingerprint)
+            self.console('Watching %s for changes, using %s' % (path, watcher.__class__.__name__))
+            self.watch(watcher)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
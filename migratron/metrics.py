@@ -0,0 +1,177 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from importlib import import_module
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+class MetricsSink(object):
+    ''' Receives structured events from the migrate command. Events are
+    run_started, run_finished, script_started, script_finished and
+    backfill_progress; see the README for the fields on each. '''
+
+    def emit(self, event, fields):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSink(MetricsSink):
+    ''' Appends one JSON object per event to a file '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, event, fields):
+        with open(self.path, 'a') as jsonl_file:
+            jsonl_file.write(json.dumps(dict(fields, event=event, time=time.time()), sort_keys=True) + '\n')
+
+
+class StatsdSink(MetricsSink):
+    ''' Fire and forget StatsD packets over UDP '''
+
+    def __init__(self, host='localhost', port=8125, prefix='migratron'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        try:
+            self.socket.sendto(('%s.%s:%s|%s' % (self.prefix, name, value, kind)).encode('utf-8'), self.address)
+        except socket.error:  # nobody listening is fine
+            pass
+
+    def emit(self, event, fields):
+        if event == 'run_started':
+            self.send('run.started', 1, 'c')
+            self.send('run.pending', fields.get('scripts', 0), 'g')
+        elif event == 'run_finished':
+            self.send('run.finished', 1, 'c')
+            self.send('run.duration', int(fields['duration'] * 1000), 'ms')
+        elif event == 'script_finished':
+            self.send('script.%s' % fields['status'], 1, 'c')
+            self.send('script.duration', int(fields['duration'] * 1000), 'ms')
+            if fields.get('rows_affected') is not None:
+                self.send('script.rows_affected', fields['rows_affected'], 'c')
+        elif event == 'backfill_progress':
+            self.send('backfill.rows_copied', fields['rows_copied'], 'g')
+            self.send('backfill.rows_total', fields['rows_total'], 'g')
+
+    def close(self):
+        self.socket.close()
+
+
+class PrometheusTextfileSink(MetricsSink):
+    ''' Rewrites a .prom file for the node_exporter textfile collector after
+    every event. The file is replaced atomically, so it is never half written.
+    Databases other than default get a file of their own, like migratron_shard_1.prom,
+    because --all-databases migrates them from separate processes. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.labels = {}
+        self.metrics = {}
+
+    def set(self, name, value):
+        self.metrics[name] = value
+
+    def inc(self, name, value=1):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def emit(self, event, fields):
+        if event == 'run_started' or not self.labels:
+            self.labels = dict(database=fields.get('database') or DEFAULT_DB_ALIAS, type=fields.get('type') or '')
+        if event == 'run_started':
+            self.set('migratron_run_in_progress', 1)
+            self.set('migratron_run_pending_scripts', fields.get('scripts', 0))
+            self.set('migratron_run_started_timestamp_seconds', time.time())
+        elif event == 'run_finished':
+            self.set('migratron_run_in_progress', 0)
+            self.set('migratron_run_duration_seconds', fields['duration'])
+            self.set('migratron_run_finished_timestamp_seconds', time.time())
+        elif event == 'script_finished':
+            self.inc('migratron_scripts_%s_total' % fields['status'])
+            self.set('migratron_last_script_duration_seconds', fields['duration'])
+            if fields.get('rows_affected') is not None:
+                self.inc('migratron_rows_affected_total', fields['rows_affected'])
+        elif event == 'backfill_progress':
+            self.set('migratron_backfill_rows_copied', fields['rows_copied'])
+            self.set('migratron_backfill_rows_total', fields['rows_total'])
+        else:
+            return
+        self.write()
+
+    def write(self):
+        labels = ','.join('%s="%s"' % (key, value.replace('"', '\\"')) for key, value in sorted(self.labels.items()))
+        lines = ['%s{%s} %r' % (name, labels, float(value)) for name, value in sorted(self.metrics.items())]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.migratron', suffix='.prom')
+        with os.fdopen(handle, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, self.database_path(self.labels['database']))
+
+    def database_path(self, database):
+        if database == DEFAULT_DB_ALIAS:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        return '%s_%s%s' % (root, database, ext)
+
+
+SINKS = {
+    'jsonl': JsonlSink,
+    'statsd': StatsdSink,
+    'prometheus': PrometheusTextfileSink,
+}
+
+
+class Metrics(object):
+    ''' Sends events to every configured sink. A broken sink is reported once
+    and then ignored, rather than stopping a migration half way through. '''
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def emit(self, event, **fields):
+        for sink in list(self.sinks):
+            try:
+                sink.emit(event, fields)
+            except Exception as e:
+                sys.stderr.write('Disabling metrics sink %s: %s\n' % (sink.__class__.__name__, e))
+                self.sinks.remove(sink)
+
+    def close(self):
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                sys.stderr.write('Could not close metrics sink %s: %s\n' % (sink.__class__.__name__, e))
+
+
+def load_sink(config):
+    ''' a sink from a MIGRATIONS_METRICS entry, like {"sink": "statsd", "port": 8125}.
+    "sink" is one of the built-in names, or the dotted path to a MetricsSink class. '''
+    config = dict(config)
+    name = config.pop('sink')
+    if name in SINKS:
+        sink_class = SINKS[name]
+    else:
+        module, _, class_name = name.rpartition('.')
+        sink_class = getattr(import_module(module), class_name)
+    return sink_class(**config)
+
+
+def get_metrics():
+    ''' a broken MIGRATIONS_METRICS entry is reported and skipped, like a sink that fails later on '''
+    sinks = []
+    for config in getattr(settings, 'MIGRATIONS_METRICS', ()):
+        try:
+            sinks.append(load_sink(config))
+        except Exception as e:
+            sys.stderr.write('Skipping metrics sink %r: %s\n' % (config, e))
+    return Metrics(sinks)
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from yamlfield.fields import YAMLField
 
 
@@ -7,11 +8,12 @@ class Migration(models.Model):
     Any migration that the system knows about, cleaned up on every run
     """
     filename = models.CharField(max_length=255)
-    type = models.CharField(max_length=255, null=True)
+    type = models.CharField(max_length=255, null=True, db_index=True)
     meta = YAMLField(null=True)
     is_deleted = models.BooleanField(default=False)
     flagged = models.BooleanField(default=False)
-    create_date = models.DateTimeField("date added", auto_now_add=True)
+    # not auto_now_add, so that --import-state can preserve the original dates
+    create_date = models.DateTimeField("date added", default=timezone.now)
 
     def __unicode__(self):
         return self.filename
@@ -19,22 +21,27 @@ class Migration(models.Model):
     @property
     def last_run(self):
         try:
-            return MigrationHistory.objects.filter(migration=self).order_by('-create_date')[0]
+            return self.migrationhistory_set.filter(failed=False).order_by('-create_date')[0]
         except IndexError:
             return None
 
     @property
     def history(self):
-        return MigrationHistory.objects.filter(migration=self).order_by('-create_date')
+        return self.migrationhistory_set.order_by('-create_date')
+
+    @property
+    def failed_runs(self):
+        return self.migrationhistory_set.filter(failed=True).order_by('-create_date')
 
 
 class MigrationHistory(models.Model):
     """
-    Successful migration runs
+    Migration runs, including failed attempts
     """
     migration = models.ForeignKey(Migration)
     meta = YAMLField(null=True)
-    create_date = models.DateTimeField("date added", auto_now_add=True)
+    failed = models.BooleanField(default=False)
+    create_date = models.DateTimeField("date added", default=timezone.now)
 
     def __unicode__(self):
         return '%s on %s' % (self.migration.filename, self.create_date)
@@ -42,3 +49,16 @@ class MigrationHistory(models.Model):
     @property
     def author_name(self):
         return self.author
+
+
+class MigrationSync(models.Model):
+    """
+    When the watchmigrations command last brought the Migration table up to date
+    with a migrations directory, and a fingerprint of the directory at the last full sync
+    """
+    type = models.CharField(max_length=255, null=True)
+    synced_at = models.DateTimeField("last synced", null=True)
+    fingerprint = models.CharField(max_length=40, null=True)
+
+    def __unicode__(self):
+        return '%s synced at %s' % (self.type, self.synced_at)
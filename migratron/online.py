@@ -0,0 +1,250 @@
+import re
+import time
+from django.db import transaction
+from migratron.sql import ALTER_TABLE
+from migratron.sql import split_statements
+
+
+class OnlineSchemaChange(object):
+    ''' Apply ALTER TABLE statements without locking the table for the whole
+    rewrite. The alterations are made to an empty shadow table, triggers on the
+    original table mirror any writes into it, existing rows are copied over in
+    small batches, and finally the two tables are swapped by renaming them.
+
+    The original table is kept as _<table>_old, for you to drop once you are
+    happy with the result. Foreign keys from other tables are not re-pointed
+    at the new table. '''
+
+    vendors = ('sqlite', 'postgresql', 'mysql')
+
+    def __init__(self, connection, table, alterations, batch_size=1000, sleep=0.05, log=None, progress_interval=5,
+                 progress=None):
+        if connection.vendor not in self.vendors:
+            raise ValueError('Online migrations are not supported on %s' % connection.vendor)
+        self.connection = connection
+        self.table = table
+        self.alterations = alterations  # everything after ALTER TABLE <table>
+        self.batch_size = int(batch_size)
+        self.sleep = float(sleep)
+        self.log = log or (lambda message: None)
+        self.progress_interval = progress_interval
+        self.progress = progress or (lambda copied, total: None)  # called every progress_interval while copying
+        self.shadow_table = '_%s_new' % table
+        self.old_table = '_%s_old' % table
+        self.trigger_prefix = '%s_migratron' % table
+        self.copied = 0
+
+    @classmethod
+    def from_sql(cls, connection, raw_sql, **kwargs):
+        ''' every statement must be an ALTER TABLE on the same table '''
+        table, alterations = None, []
+        for statement in split_statements(raw_sql):
+            match = ALTER_TABLE.match(statement)
+            if not match:
+                raise ValueError('Online migrations can only contain ALTER TABLE statements, not "%s"' % statement)
+            name = match.group(1).strip('"`')
+            if table and name != table:
+                raise ValueError('Online migrations can only alter one table, not both %s and %s' % (table, name))
+            table = name
+            alterations.append(statement[match.end():].strip())
+        if not table:
+            raise ValueError('Online migrations must contain an ALTER TABLE statement')
+        return cls(connection, table, alterations, **kwargs)
+
+    def qn(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def execute(self, sql, params=None):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def columns(self, table):
+        cursor = self.connection.cursor()
+        return [column[0] for column in self.connection.introspection.get_table_description(cursor, table)]
+
+    def primary_key(self):
+        introspection = self.connection.introspection
+        if hasattr(introspection, 'get_primary_key_column'):
+            return introspection.get_primary_key_column(self.connection.cursor(), self.table) or 'id'
+        return 'id'
+
+    def run(self):
+        self.prepare()
+        try:
+            self.copy()
+        except:
+            self.abort()
+            raise
+        self.swap()
+        return self.copied
+
+    def prepare(self):
+        if self.shadow_table in self.connection.introspection.table_names():
+            raise ValueError('%s already exists, probably left over from an earlier online migration' % self.shadow_table)
+        self.pk = self.primary_key()
+        self.log('Creating shadow table %s' % self.shadow_table)
+        with transaction.atomic(using=self.connection.alias):
+            self.create_shadow_table()
+            for alteration in self.alterations:
+                self.execute('ALTER TABLE %s %s' % (self.qn(self.shadow_table), alteration))
+            shadow_columns = self.columns(self.shadow_table)
+            self.common_columns = [column for column in self.columns(self.table) if column in shadow_columns]
+            if self.pk not in self.common_columns:
+                raise ValueError('Online migrations cannot drop or rename the primary key of %s' % self.table)
+            self.create_triggers()
+
+    def create_shadow_table(self):
+        vendor = self.connection.vendor
+        if vendor == 'postgresql':
+            self.execute('CREATE TABLE %s (LIKE %s INCLUDING ALL)' % (self.qn(self.shadow_table), self.qn(self.table)))
+        elif vendor == 'mysql':
+            self.execute('CREATE TABLE %s LIKE %s' % (self.qn(self.shadow_table), self.qn(self.table)))
+        else:
+            # sqlite has no CREATE TABLE LIKE; re-use the original DDL. Indexes are recreated in swap()
+            create_sql = self.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table]).fetchone()[0]
+            self.execute(re.sub(r'^CREATE\s+TABLE\s+["`\[]?%s["`\]]?' % re.escape(self.table),
+                'CREATE TABLE %s' % self.qn(self.shadow_table), create_sql, count=1, flags=re.IGNORECASE))
+
+    def _mirror_sql(self, row):
+        ''' statements that make the shadow table's copy of a row (NEW or OLD) match the original '''
+        columns = ', '.join(self.qn(column) for column in self.common_columns)
+        values = ', '.join('%s.%s' % (row, self.qn(column)) for column in self.common_columns)
+        return 'INSERT INTO %s (%s) VALUES (%s)' % (self.qn(self.shadow_table), columns, values)
+
+    def _delete_sql(self, row):
+        return 'DELETE FROM %s WHERE %s = %s.%s' % (self.qn(self.shadow_table), self.qn(self.pk), row, self.qn(self.pk))
+
+    def create_triggers(self):
+        statements = {
+            'INSERT': [self._delete_sql('NEW'), self._mirror_sql('NEW')],
+            'UPDATE': [self._delete_sql('OLD'), self._delete_sql('NEW'), self._mirror_sql('NEW')],
+            'DELETE': [self._delete_sql('OLD')],
+        }
+        vendor = self.connection.vendor
+        if vendor == 'postgresql':
+            body = ''.join("IF TG_OP = '%s' THEN %s; END IF; " % (op, '; '.join(sql)) for op, sql in statements.items())
+            self.execute('CREATE FUNCTION %s() RETURNS trigger AS $$ BEGIN %sRETURN NULL; END; $$ LANGUAGE plpgsql' % (
+                self.qn(self.trigger_prefix), body))
+            self.execute('CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s FOR EACH ROW EXECUTE PROCEDURE %s()' % (
+                self.qn(self.trigger_prefix), self.qn(self.table), self.qn(self.trigger_prefix)))
+            return
+        for op, sql in statements.items():
+            name = self.qn('%s_%s' % (self.trigger_prefix, op.lower()))
+            if vendor == 'mysql':
+                self.execute('CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW BEGIN %s; END' % (
+                    name, op, self.qn(self.table), '; '.join(sql)))
+            else:
+                self.execute('CREATE TRIGGER %s AFTER %s ON %s BEGIN %s; END' % (
+                    name, op, self.qn(self.table), '; '.join(sql)))
+
+    def drop_triggers(self):
+        if self.connection.vendor == 'postgresql':
+            self.execute('DROP TRIGGER IF EXISTS %s ON %s' % (self.qn(self.trigger_prefix), self.qn(self.table)))
+            self.execute('DROP FUNCTION IF EXISTS %s()' % self.qn(self.trigger_prefix))
+            return
+        for op in ('insert', 'update', 'delete'):
+            self.execute('DROP TRIGGER IF EXISTS %s' % self.qn('%s_%s' % (self.trigger_prefix, op)))
+
+    def batch_sql(self, bounded):
+        ''' INSERT ... SELECT for the rows between two primary keys, including the upper
+        one unless bounded. The source rows are share locked, so that a concurrent DELETE
+        either waits for the batch (and its trigger then removes the copy), or commits
+        first and the row is skipped. Otherwise postgres, and mysql at READ COMMITTED,
+        would copy rows from a snapshot, and a row deleted after it would survive the swap. '''
+        vendor = self.connection.vendor
+        columns = ', '.join(self.qn(column) for column in self.common_columns)
+        insert = {'sqlite': 'INSERT OR IGNORE INTO', 'mysql': 'INSERT IGNORE INTO'}.get(vendor, 'INSERT INTO')
+        lock = {'postgresql': ' FOR SHARE', 'mysql': ' LOCK IN SHARE MODE'}.get(vendor, '')
+        on_conflict = ' ON CONFLICT DO NOTHING' if vendor == 'postgresql' else ''
+        pk = self.qn(self.pk)
+        where = '%s >= %%s AND %s %s %%s' % (pk, pk, '<' if bounded else '<=')
+        return '%s %s (%s) SELECT %s FROM %s WHERE %s%s%s' % (
+            insert, self.qn(self.shadow_table), columns, columns, self.qn(self.table), where, lock, on_conflict)
+
+    def copy(self):
+        ''' copy existing rows in primary key order, one short transaction per batch.
+        Rows the triggers have already mirrored are left alone. '''
+        pk, table = self.qn(self.pk), self.qn(self.table)
+
+        low, high = self.execute('SELECT MIN(%s), MAX(%s) FROM %s' % (pk, pk, table)).fetchone()
+        total = self.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+        start = last_progress = time.time()
+        while low is not None and low <= high:
+            with transaction.atomic(using=self.connection.alias):
+                row = self.execute('SELECT %s FROM %s WHERE %s >= %%s ORDER BY %s LIMIT 1 OFFSET %s' % (
+                    pk, table, pk, pk, self.batch_size), [low]).fetchone()
+                upper = row[0] if row and row[0] <= high else None
+                cursor = self.execute(self.batch_sql(upper is not None), [low, upper if upper is not None else high])
+                self.copied += max(cursor.rowcount, 0)
+            if time.time() - last_progress >= self.progress_interval:
+                rate = self.copied / max(time.time() - start, 0.001)
+                eta = ', about %ds to go' % ((total - self.copied) / rate) if rate and total > self.copied else ''
+                self.log('Copied %s of ~%s rows into %s, %d rows/s%s' % (
+                    self.copied, total, self.shadow_table, rate, eta))
+                self.progress(self.copied, total)
+                last_progress = time.time()
+            if upper is None:
+                break
+            low = upper
+            if self.sleep:
+                time.sleep(self.sleep)  # throttle, to leave room for replication and other writes
+        self.log('Copied %s rows into %s' % (self.copied, self.shadow_table))
+        self.progress(self.copied, total)
+        return self.copied
+
+    def swap(self):
+        self.log('Swapping %s and %s' % (self.table, self.shadow_table))
+        vendor = self.connection.vendor
+        if vendor == 'mysql':
+            # DDL commits implicitly on mysql, so atomic() can't protect anything here. Rename first,
+            # in one atomic statement, so that no write lands between dropping the triggers and the
+            # swap; the triggers move along with the original table, which nothing writes to any more.
+            self.execute('RENAME TABLE %s TO %s, %s TO %s' % (
+                self.qn(self.table), self.qn(self.old_table), self.qn(self.shadow_table), self.qn(self.table)))
+            self.drop_triggers()
+        else:
+            with transaction.atomic(using=self.connection.alias):
+                self.drop_triggers()
+                if vendor == 'postgresql':
+                    sequences = self.sequences()
+                    self.execute('ALTER TABLE %s RENAME TO %s' % (self.qn(self.table), self.qn(self.old_table)))
+                    self.execute('ALTER TABLE %s RENAME TO %s' % (self.qn(self.shadow_table), self.qn(self.table)))
+                    for column, sequence, shadow_sequence in sequences:
+                        if shadow_sequence:
+                            # identity columns get a sequence of their own, starting from 1
+                            self.execute('SELECT setval(%s, nextval(%s))', [shadow_sequence, sequence])
+                        else:
+                            # serial defaults were copied, but the sequence still belongs to the old table,
+                            # so dropping it would fail, or with CASCADE strip the live table's default
+                            self.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (sequence, self.qn(self.table), self.qn(column)))
+                else:
+                    indexes = self.execute(
+                        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+                        [self.table]).fetchall()
+                    # otherwise sqlite re-points foreign keys in other tables at the renamed original
+                    self.execute('PRAGMA legacy_alter_table = ON')
+                    self.execute('ALTER TABLE %s RENAME TO %s' % (self.qn(self.table), self.qn(self.old_table)))
+                    self.execute('ALTER TABLE %s RENAME TO %s' % (self.qn(self.shadow_table), self.qn(self.table)))
+                    self.execute('PRAGMA legacy_alter_table = OFF')
+                    for name, create_sql in indexes:
+                        self.execute('DROP INDEX %s' % self.qn(name))
+                        self.execute(create_sql)
+        self.log('Done. The original table is still available as %s' % self.old_table)
+
+    def sequences(self):
+        ''' (column, sequence, shadow table's sequence) for postgres serial and identity columns '''
+        sequences = []
+        for column in self.common_columns:
+            sequence, shadow_sequence = self.execute('SELECT pg_get_serial_sequence(%s, %s), pg_get_serial_sequence(%s, %s)', [
+                self.qn(self.table), column, self.qn(self.shadow_table), column]).fetchone()
+            if sequence:
+                sequences.append((column, sequence, shadow_sequence))
+        return sequences
+
+    def abort(self):
+        self.log('Removing %s' % self.shadow_table)
+        with transaction.atomic(using=self.connection.alias):
+            self.drop_triggers()
+            self.execute('DROP TABLE IF EXISTS %s' % self.qn(self.shadow_table))
@@ -0,0 +1,164 @@
+import math
+import re
+from contextlib import contextmanager
+from django.db import transaction
+
+
+ALTER_TABLE = re.compile(r'^ALTER\s+TABLE\s+(?:ONLY\s+)?(?:IF\s+EXISTS\s+)?([\w."`]+)', re.IGNORECASE)
+EXPLAINABLE = re.compile(r'^(?:SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+NO_WHERE = re.compile(r'^(?:UPDATE|DELETE)\b(?!.*\bWHERE\b)', re.IGNORECASE | re.DOTALL)
+FULL_SCAN = re.compile(r'\b(?:Seq Scan on|SCAN TABLE|SCAN)\s+([\w."`]+)')
+DOLLAR_QUOTE = re.compile(r'\$(?:[A-Za-z_]\w*)?\$')
+TRANSACTION_CONTROL = re.compile(r'^(?:BEGIN|START\s+TRANSACTION|COMMIT|ROLLBACK|END|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+CLIENT_COMMAND = re.compile(r'^\s*(?:\\|DELIMITER\b)', re.IGNORECASE | re.MULTILINE)
+
+
+def split_statements(raw_sql):
+    ''' split a script on semicolons, ignoring any inside quotes or postgres
+    $$ dollar quotes, and dropping comments (including the meta-data header). '''
+    statements, current = [], []
+    quote = None
+    i, length = 0, len(raw_sql)
+    while i < length:
+        char = raw_sql[i]
+        if quote:
+            current.append(char)
+            if char == '\\' and i + 1 < length:
+                current.append(raw_sql[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+            current.append(char)
+        elif char == '$' and DOLLAR_QUOTE.match(raw_sql, i) and not (current and (current[-1].isalnum() or current[-1] == '_')):
+            tag = DOLLAR_QUOTE.match(raw_sql, i).group(0)
+            end = raw_sql.find(tag, i + len(tag))
+            end = length if end == -1 else end + len(tag)
+            current.append(raw_sql[i:end])
+            i = end
+            continue
+        elif raw_sql.startswith('--', i):
+            end = raw_sql.find('\n', i)
+            i = length if end == -1 else end
+            continue
+        elif raw_sql.startswith('/*', i):
+            end = raw_sql.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            current.append(' ')
+            continue
+        elif char == ';':
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def can_run_on_connection(raw_sql):
+    ''' false for scripts that need the database's own client: ones that manage their own
+    transactions, which can't work inside transaction.atomic, or that use client commands
+    like psql's \\set or mysql's DELIMITER, which split_statements doesn't understand '''
+    if CLIENT_COMMAND.search(raw_sql):
+        return False
+    return not any(TRANSACTION_CONTROL.match(statement) for statement in split_statements(raw_sql))
+
+
+def _summary(statement, length=60):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= length else statement[:length - 3] + '...'
+
+
+def full_table_scans(connection, statement):
+    ''' tables that the database plans to read in full, according to EXPLAIN.
+    None of the supported databases actually run the statement. '''
+    vendor = connection.vendor
+    prefix = 'EXPLAIN QUERY PLAN ' if vendor == 'sqlite' else 'EXPLAIN '
+    with transaction.atomic(using=connection.alias):
+        cursor = connection.cursor()
+        cursor.execute(prefix + statement)
+        columns = [column[0].lower() for column in cursor.description]
+        rows = cursor.fetchall()
+    tables = []
+    for row in rows:
+        if vendor == 'mysql':
+            row = dict(zip(columns, row))
+            if row.get('type') == 'ALL':
+                tables.append(row.get('table'))
+        else:
+            text = ' '.join(str(column) for column in row)
+            match = FULL_SCAN.search(text)
+            if match and 'USING' not in text:  # sqlite covering index scans are fine
+                tables.append(match.group(1))
+    return tables
+
+
+def explain_warnings(connection, raw_sql):
+    ''' human readable warnings about statements that are likely to be slow
+    on large tables, for migrate --plan --explain '''
+    warnings = []
+    for statement in split_statements(raw_sql):
+        match = ALTER_TABLE.match(statement)
+        if match:
+            warnings.append('ALTER TABLE %s may lock or rewrite the whole table' % match.group(1))
+            continue
+        if NO_WHERE.match(statement):
+            warnings.append('"%s" has no WHERE clause, and will touch every row' % _summary(statement))
+        if EXPLAINABLE.match(statement):
+            try:
+                for table in full_table_scans(connection, statement):
+                    warnings.append('"%s" does a full table scan on %s; is there a missing index?' % (
+                        _summary(statement), table))
+            except Exception as e:  # tables created earlier in the same script won't exist yet
+                warnings.append('Could not EXPLAIN "%s": %s' % (_summary(statement), e))
+    return warnings
+
+
+def timeout_statements(vendor, lock_timeout=None, statement_timeout=None):
+    ''' session statements that limit how long to wait for locks, and how long
+    a single statement may run, in seconds. sqlite only has a lock (busy) timeout. '''
+    statements = []
+    if vendor == 'postgresql':
+        if lock_timeout is not None:
+            statements.append("SET lock_timeout = '%dms'" % (lock_timeout * 1000))
+        if statement_timeout is not None:
+            statements.append("SET statement_timeout = '%dms'" % (statement_timeout * 1000))
+    elif vendor == 'mysql':
+        if lock_timeout is not None:
+            seconds = max(1, int(math.ceil(lock_timeout)))
+            statements.append('SET SESSION lock_wait_timeout = %d' % seconds)
+            statements.append('SET SESSION innodb_lock_wait_timeout = %d' % seconds)
+        if statement_timeout is not None:
+            statements.append('SET SESSION max_execution_time = %d' % (statement_timeout * 1000))
+    elif vendor == 'sqlite':
+        if lock_timeout is not None:
+            statements.append('PRAGMA busy_timeout = %d' % (lock_timeout * 1000))
+    return statements
+
+
+@contextmanager
+def connection_timeouts(connection, lock_timeout=None, statement_timeout=None):
+    ''' apply timeout_statements() to a Django connection, and put things back afterwards '''
+    statements = timeout_statements(connection.vendor, lock_timeout, statement_timeout)
+    if not statements:
+        yield
+        return
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA busy_timeout')
+        reset = ['PRAGMA busy_timeout = %d' % cursor.fetchone()[0]]
+    elif connection.vendor == 'postgresql':
+        reset = ['RESET lock_timeout', 'RESET statement_timeout']
+    else:
+        reset = ['SET SESSION %s = DEFAULT' % variable for variable in (
+            'lock_wait_timeout', 'innodb_lock_wait_timeout', 'max_execution_time')]
+    for statement in statements:
+        cursor.execute(statement)
+    try:
+        yield
+    finally:
+        cursor = connection.cursor()
+        for statement in reset:
+            cursor.execute(statement)
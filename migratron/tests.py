@@ -1,14 +1,40 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
 from StringIO import StringIO
 from datetime import datetime
 from mock import MagicMock
 from mock import call
 from mock import patch
+from django.db import connection
 from django.test import TestCase
 from django.test import TransactionTestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 from migratron.models import Migration
 from migratron.models import MigrationHistory
+from migratron.models import MigrationSync
 from migratron.management.commands.migrate import Command
+from migratron.management.commands.migrate import MigrationTimeout
+from migratron.management.commands.watchmigrations import Command as WatchCommand
+from migratron.metrics import JsonlSink
+from migratron.metrics import Metrics
+from migratron.metrics import PrometheusTextfileSink
+from migratron.metrics import StatsdSink
+from migratron.metrics import get_metrics
+from migratron.online import OnlineSchemaChange
+from migratron.sql import can_run_on_connection
+from migratron.sql import explain_warnings
+from migratron.sql import split_statements
+from migratron.sql import timeout_statements
+from migratron.watcher import EVENT
+from migratron.watcher import IN_CREATE
+from migratron.watcher import IN_Q_OVERFLOW
+from migratron.watcher import InotifyWatcher
+from migratron.watcher import PollingWatcher
 
 
 def MigrationFactory(*args, **kwargs):
@@ -35,7 +61,7 @@ class MigrateModelTest(TestCase):
         self.assertTrue(MigrationFactory(filename='foobar.sql').id)
 
 
-def log_to_self(self, message, color=None, newline=True):
+def log_to_self(self, message='', color=None, newline=True):
     ''' log print calls to a list of messages on self, so we can assert on them
     some trickiness here to emulate print()'s ability to either print a carriage
     return, or not
@@ -222,6 +248,31 @@ class MigrateCommandTest(TestCase):
         command.run(MigrationFactory(filename='foo.sql', history=False))  # no exception thrown
         self.assertTrue(MigrationHistory.objects.all())  # record was inserted
 
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_run_emits_events(self):
+        command = MigrateCommandFactory(all_scripts=['bar.py'])
+        command.execfile = MagicMock(return_value=True)
+        command.metrics = Metrics([MagicMock()])
+        command.run(MigrationFactory(filename='bar.py', history=False))
+        events = [args for args, kwargs in command.metrics.sinks[0].emit.call_args_list]
+        self.assertEquals([event for event, fields in events], ['script_started', 'script_finished'])
+        self.assertEquals(events[1][1]['status'], 'ok')
+        self.assertEquals(events[1][1]['script'], 'bar.py')
+
+    def test_run_in_order_closes_metrics(self):
+        command = MigrateCommandFactory()
+        command.run = MagicMock()
+        metrics = command.metrics = Metrics([MagicMock()])
+        command.run_in_order([MigrationFactory(filename='foo.sql', history=False)])
+        events = [args[0] for args, kwargs in metrics.sinks[0].emit.call_args_list]
+        self.assertEquals(events, ['run_started', 'run_finished'])
+        self.assertTrue(metrics.sinks[0].close.called)
+        self.assertEquals(command.metrics, None)
+
+    def test_progress_line(self):
+        self.assertEquals(MigrateCommandFactory()._progress_line(2, 6, 60),
+            'Progress: 2 of 6 scripts in 1m 00s, 2.0 scripts/min, about 2m 00s to go')
+
     def test_delete_log(self):
         migration = MigrationFactory(filename='foo.sql')
         command = MigrateCommandFactory(specific_migration='foo.sql')
@@ -234,6 +285,232 @@ class MigrateCommandTest(TestCase):
         command.delete_log()
         self.assertFalse(MigrationHistory.objects.filter(id=migration.id))
 
+    def test_resolve_migrations(self):
+        MigrationFactory(filename='hotfix_1.sql', history=False)
+        MigrationFactory(filename='hotfix_2.py', history=False)
+        MigrationFactory(filename='other.sql', history=False)
+        command = MigrateCommandFactory()
+        self.assertEquals([m.filename for m in command.resolve_migrations(['hotfix_*', 'other.sql'])],
+            ['other.sql', 'hotfix_2.py', 'hotfix_1.sql'])
+
+    def test_resolve_migrations_regex(self):
+        MigrationFactory(filename='hotfix_1.sql', history=False)
+        MigrationFactory(filename='hotfix_2.py', history=False)
+        command = MigrateCommandFactory(regex=True)
+        self.assertEquals([m.filename for m in command.resolve_migrations([r'_\d\.sql$'])], ['hotfix_1.sql'])
+
+    def test_resolve_migrations_not_found(self):
+        command = MigrateCommandFactory()
+        with self.assertRaises(SystemExit):
+            command.resolve_migrations(['hotfix_*'])
+
+    def test_log_only_many(self):
+        MigrationFactory(filename='hotfix_1.sql', history=False)
+        MigrationFactory(filename='hotfix_2.sql')
+        command = MigrateCommandFactory(log_only=True)
+        command.run_many(command.resolve_migrations(['hotfix_*']))
+        self.assertEquals(MigrationHistory.objects.count(), 2)  # hotfix_2.sql was not logged again
+        self.assertTrue(Migration.objects.get(filename='hotfix_1.sql').history)
+
+    def test_run_all_log_only(self):
+        MigrationFactory(filename='foo.sql', history=False)
+        MigrationFactory(filename='bar.py', history=False)
+        command = MigrateCommandFactory(log_only=True)
+        command.run_all()
+        self.assertFalse(command.pending)
+
+    def test_delete_log_many(self):
+        MigrationFactory(filename='hotfix_1.sql')
+        MigrationFactory(filename='hotfix_2.sql')
+        MigrationFactory(filename='other.sql')
+        command = MigrateCommandFactory()
+        command.specific_migrations = command.resolve_migrations(['hotfix_*'])
+        command.delete_log()
+        self.assertEquals([h.migration.filename for h in MigrationHistory.objects.all()], ['other.sql'])
+
+    def test_log_migration_duration(self):
+        migration = MigrationFactory(filename='foo.sql', history=False)
+        MigrateCommandFactory().log_migration(migration, 1.23456)
+        self.assertEquals(migration.last_run.meta['duration'], 1.235)
+
+    def test_plan(self):
+        done = MigrationFactory(filename='done.sql')
+        history = done.last_run
+        history.meta = dict(duration=30)
+        history.save()
+        migration = MigrationFactory(filename='foo.sql', history=False)
+        migration.meta = dict(estimate='5m', Description='Add a column')
+        migration.save()
+        MigrationFactory(filename='bar.sql', history=False)
+        command = MigrateCommandFactory()
+        command.plan()
+        self.assertEquals(command.output, '\n'.join([
+            'Plan:',
+            '    5m 00s   foo.sql',
+            '            Description: Add a column',
+            '       30s   bar.sql',
+            'Estimated total: 5m 30s']))
+
+    def test_parse_duration(self):
+        command = MigrateCommandFactory()
+        self.assertEquals([command._parse_duration(value) for value in (90, '500ms', '90s', ' 2m ', '1h', '1d', 'abc')],
+            [90, 0.5, 90, 120, 3600, None, None])
+
+    def test_timeout_unparseable(self):
+        command = MigrateCommandFactory(lock_timeout='1d')
+        with self.assertRaises(SystemExit):
+            command._timeout({}, 'lock_timeout')
+
+    def test_timeout_not_swallowed_by_except_exception(self):
+        command = MigrateCommandFactory()
+        with self.assertRaises(MigrationTimeout):
+            try:
+                with command.wall_clock_timeout(0.01):
+                    time.sleep(1)
+            except Exception:
+                pass
+
+    def test_plan_unicode(self):
+        migration = MigrationFactory(filename='foo.sql', history=False)
+        migration.meta = dict(estimate='5m', Author=u'Jos\xe9')
+        migration.save()
+        command = MigrateCommandFactory()
+        command.plan()
+        self.assertTrue(u'            Author: Jos\xe9' in command.output)
+
+    def test_plan_no_estimate(self):
+        MigrationFactory(filename='foo.py', history=False)
+        command = MigrateCommandFactory()
+        command.plan()
+        self.assertEquals(command.output, 'Plan:\n         ?   foo.py\nEstimated total: <1s, plus 1 script(s) with no estimate')
+
+    @override_settings(MIGRATIONS_TIMEOUT='1h')
+    def test_timeout_precedence(self):
+        command = MigrateCommandFactory(timeout='10')
+        self.assertEquals(command._timeout({'timeout': '2m'}, 'timeout'), 120)
+        self.assertEquals(command._timeout({}, 'timeout'), 10)
+        command.timeout = None
+        self.assertEquals(command._timeout({}, 'timeout'), 3600)
+        self.assertEquals(command._timeout({}, 'lock_timeout'), None)
+
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_run_timeout(self):
+        migration = MigrationFactory(filename='bar.py', history=False)
+        command = MigrateCommandFactory(timeout='0.1', continue_on_errors=True)
+        command.execfile = lambda filename: time.sleep(5)
+        command.run(migration)
+        self.assertTrue(command.timed_out)
+        self.assertTrue(migration in command.pending)  # failed attempts don't count as run
+        failed_run = migration.failed_runs[0]
+        self.assertEquals(failed_run.meta['error'], 'timeout')
+        self.assertTrue(failed_run.meta['duration'] < 5)
+
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_run_failed_aborts(self):
+        migration = MigrationFactory(filename='foo.sql', history=False)
+        command = MigrateCommandFactory()
+        command.execute_sql = MagicMock(return_value=False)
+        mocked_open = mock_open(data=StringIO('select 0;'))
+        with self.assertRaises(SystemExit):
+            with patch('__builtin__.open', mocked_open, create=True):
+                command.run(migration)
+        self.assertEquals(migration.failed_runs[0].meta['error'], 'error')
+        self.assertFalse(migration.last_run)
+
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_run_py_other_database_requires_multi_db(self):
+        command = MigrateCommandFactory(all_scripts=['bar.py'], database='shard_1')
+        command.execfile = MagicMock(return_value=True)
+        with self.assertRaises(SystemExit):
+            command.run(MigrationFactory(filename='bar.py', history=False))
+        self.assertFalse(command.execfile.called)
+
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_run_sql_over_connection_falls_back_to_dbshell(self):
+        migration = MigrationFactory(filename='foo.sql', history=False)
+        command = MigrateCommandFactory(sql_over_connection=True)
+        command.execute_sql = MagicMock(return_value=True)
+        command.execute_sql_statements = MagicMock(return_value=True)
+        mocked_open = mock_open(data=StringIO('BEGIN; update foo set bar = 1; COMMIT;'))
+        with patch('__builtin__.open', mocked_open, create=True):
+            command.run(migration)
+        self.assertTrue(command.execute_sql.called)
+        self.assertFalse(command.execute_sql_statements.called)
+
+    @override_settings(MIGRATIONS_DATABASES=('shard_2', 'shard_1'))
+    def test_databases(self):
+        self.assertEquals(MigrateCommandFactory().databases(), ['shard_2', 'shard_1'])
+
+    @override_settings(MIGRATIONS_DATABASES=('shard_1', 'shard_22'))
+    def test_run_on_all_databases(self):
+        results = {
+            'shard_1': dict(database='shard_1', status='ok', applied=2, failed_at='', output='Running foo.sql\n'),
+            'shard_22': dict(database='shard_22', status='failed', applied=1, failed_at='bar.sql', output=''),
+        }
+        fake_pool = MagicMock()
+        fake_pool.imap_unordered = lambda func, jobs: [results[database] for database, args, options in jobs]
+        command = MigrateCommandFactory()
+        with patch('multiprocessing.Pool', MagicMock(return_value=fake_pool)):
+            with patch('migratron.management.commands.migrate.connections', MagicMock()):
+                with self.assertRaises(SystemExit):
+                    command.run_on_all_databases((), {})
+        self.assertEquals(command.messages[-4:], [
+            'Database  Status  Applied  Failed at',
+            'shard_1   ok            2  ',
+            'shard_22  failed        1  bar.sql',
+            '1 of 2 databases failed'])
+
+    def test_missing_from_same_database(self):
+        MigrationFactory(filename='foo.sql')
+        self.assertEquals(MigrateCommandFactory().missing_from('default'), [])
+
+    @override_settings(MIGRATIONS_DIR='/tmp')
+    def test_replay(self):
+        pre = MigrationFactory(filename='foo.sql', type='pre', history=False)
+        post = MigrationFactory(filename='bar.py', type='post', history=False)
+        command = MigrateCommandFactory(replay_from='source')
+        command.missing_from = MagicMock(return_value=[post, pre])
+        types = []
+        command.run = MagicMock(side_effect=lambda migration: types.append((command.type, command.sql_over_connection)))
+        command.replay()
+        self.assertEquals(command.run.call_args_list, [call(post), call(pre)])
+        self.assertEquals(types, [('post', True), ('pre', True)])
+        self.assertEquals((command.type, command.sql_over_connection), (None, False))
+
+    def test_sync_if_needed_recent_watcher_sync(self):
+        # the watcher may not have caught up with a git pull yet, so only the fingerprint counts
+        command = MigrateCommandFactory(type='pre')
+        command.sync_filesystem_and_db = MagicMock()
+        MigrationSync(type='pre', synced_at=timezone.now(), fingerprint='stale').save()
+        command.sync_if_needed()
+        self.assertTrue(command.sync_filesystem_and_db.called)
+
+    def test_sync_if_needed_fingerprint(self):
+        migrations_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, migrations_dir)
+        with self.settings(MIGRATIONS_DIR=migrations_dir):
+            command = MigrateCommandFactory()
+            command.sync_filesystem_and_db = MagicMock()
+            command.sync_if_needed()
+            command.sync_if_needed()
+            self.assertEquals(command.sync_filesystem_and_db.call_count, 1)
+            with open(os.path.join(migrations_dir, 'foo.sql'), 'w') as script:
+                script.write('select 1;')
+            command.sync_if_needed()
+            self.assertEquals(command.sync_filesystem_and_db.call_count, 2)
+            self.assertEquals(MigrationSync.objects.filter(type=None).count(), 1)
+
+    def test_directory_fingerprint_non_ascii(self):
+        migrations_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, migrations_dir)
+        with open(os.path.join(migrations_dir, 'caf\xc3\xa9.sql'), 'w') as script:
+            script.write('select 1;')
+        command = MigrateCommandFactory()
+        with self.settings(MIGRATIONS_DIR=migrations_dir):
+            fingerprint = command.directory_fingerprint()
+        with self.settings(MIGRATIONS_DIR=migrations_dir.decode('ascii')):
+            self.assertEquals(command.directory_fingerprint(), fingerprint)
+
     def test_none_is_pending(self):
         self.assertFalse(MigrateCommandFactory().pending)
 
@@ -241,6 +518,229 @@ class MigrateCommandTest(TestCase):
         MigrationFactory(filename='foo.sql')
         self.assertFalse(MigrateCommandFactory().pending)
 
+    def _state_file(self):
+        state_file = tempfile.NamedTemporaryFile(suffix='.yaml', delete=False)
+        state_file.close()
+        self.addCleanup(os.remove, state_file.name)
+        return state_file
+
+    def test_export_import_state(self):
+        MigrationFactory(filename='foo.sql', type='pre', create_date=datetime(2012, 10, 25, 10, 42))
+        MigrationFactory(filename='bar.py', history=False)
+        state_file = self._state_file()
+        MigrateCommandFactory(export_state_file=state_file.name).export_state()
+        MigrationHistory.objects.all().delete()
+        Migration.objects.all().delete()
+        MigrateCommandFactory(import_state_file=state_file.name).import_state()
+        self.assertEquals(Migration.objects.count(), 2)
+        migration = Migration.objects.get(filename='foo.sql', type='pre')
+        self.assertEquals(migration.last_run.create_date, datetime(2012, 10, 25, 10, 42))
+        self.assertFalse(Migration.objects.get(filename='bar.py').history)
+
+    def test_import_state_requires_merge(self):
+        MigrationFactory(filename='foo.sql')
+        state_file = self._state_file()
+        MigrateCommandFactory(export_state_file=state_file.name).export_state()
+        command = MigrateCommandFactory(import_state_file=state_file.name)
+        with self.assertRaises(SystemExit):
+            command.import_state()
+
+    def test_import_state_merge(self):
+        MigrationFactory(filename='foo.sql', create_date=datetime(2012, 10, 25, 10, 42))
+        MigrationFactory(filename='bar.sql', create_date=datetime(2012, 10, 26, 10, 42))
+        state_file = self._state_file()
+        MigrateCommandFactory(export_state_file=state_file.name).export_state()
+        Migration.objects.get(filename='bar.sql').delete()
+        command = MigrateCommandFactory(import_state_file=state_file.name, merge=True)
+        command.get_directory_listing = MagicMock(return_value=['foo.sql'])
+        command.import_state()
+        self.assertEquals(MigrationHistory.objects.count(), 2)  # foo.sql history not duplicated
+        self.assertTrue(Migration.objects.get(filename='bar.sql').is_deleted)
+
+
+class WatchCommandTest(TestCase):
+
+    def setUp(self):
+        self.migrations_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.migrations_dir)
+        self.command = WatchCommand()
+        self.command.console = MagicMock()
+
+    def _write(self, filename, contents):
+        with open(os.path.join(self.migrations_dir, filename), 'w') as script:
+            script.write(contents)
+
+    def test_apply_changes(self):
+        with self.settings(MIGRATIONS_DIR=self.migrations_dir):
+            self._write('foo.sql', '/*\nDescription: first\n*/\nselect 1;')
+            self.command.apply_changes({'foo.sql': 'created'})
+            self.assertEquals(Migration.objects.get(filename='foo.sql').meta['Description'], 'first')
+            self._write('foo.sql', '/*\nDescription: second\n*/\nselect 1;')
+            self.command.apply_changes({'foo.sql': 'modified'})
+            self.assertEquals(Migration.objects.get(filename='foo.sql').meta['Description'], 'second')
+            os.remove(os.path.join(self.migrations_dir, 'foo.sql'))
+            self.command.apply_changes({'foo.sql': 'deleted'})
+            self.assertTrue(Migration.objects.get(filename='foo.sql').is_deleted)
+
+    def test_record_watermark(self):
+        self.command.record_watermark('abc')
+        self.command.record_watermark('def')
+        self.assertEquals(MigrationSync.objects.get(type=None).fingerprint, 'def')
+
+    def test_apply_events_overflow(self):
+        with self.settings(MIGRATIONS_DIR=self.migrations_dir):
+            Migration.objects.filter(pk=MigrationFactory(filename='foo.sql').pk).update(is_deleted=True)
+            MigrationFactory(filename='gone.sql')
+            self._write('foo.sql', '/*\nDescription: new\n*/\nselect 1;')
+            self._write('bar.sql', 'select 1;')
+            self.command.apply_events([('created', 'foo.sql'), ('overflow', None)])
+            foo = Migration.objects.get(filename='foo.sql')
+            self.assertEquals((foo.meta['Description'], foo.is_deleted), ('new', False))
+            self.assertFalse(Migration.objects.get(filename='bar.sql').is_deleted)
+            self.assertTrue(Migration.objects.get(filename='gone.sql').is_deleted)
+
+    def test_watcher_started_before_first_sync(self):
+        order = []
+        self.command.sync_filesystem_and_db = MagicMock(side_effect=lambda: order.append('sync'))
+        self.command.watch = MagicMock(side_effect=KeyboardInterrupt)
+        self.command.failfast_bad_type = MagicMock()
+        watcher = MagicMock()
+        with self.settings(MIGRATIONS_DIR=self.migrations_dir):
+            with patch('migratron.management.commands.watchmigrations.get_watcher',
+                       side_effect=lambda path, poll: order.append('watch') or watcher):
+                self.command.handle()
+        self.assertEquals(order, ['watch', 'sync'])
+        self.assertTrue(watcher.close.called)
+
+    def test_apply_events_ignores_editor_files(self):
+        self.command.apply_changes = MagicMock()
+        self.command.apply_events([('created', 'foo.sql'), ('created', '.foo.sql.swp'), ('modified', 'foo.sql~'),
+            ('modified', 'foo.sql')])
+        self.command.apply_changes.assert_called_with({'foo.sql': 'modified'})
+
+    def test_inotify_overflow(self):
+        watcher = InotifyWatcher.__new__(InotifyWatcher)
+        watcher.fd, write_fd = os.pipe()
+        self.addCleanup(os.close, watcher.fd)
+        os.write(write_fd, EVENT.pack(-1, IN_Q_OVERFLOW, 0, 0) + EVENT.pack(1, IN_CREATE, 0, 8) + 'foo.sql\0')
+        os.close(write_fd)
+        self.assertEquals(watcher.events(0), [('overflow', None), ('created', 'foo.sql')])
+
+    def test_polling_watcher(self):
+        watcher = PollingWatcher(self.migrations_dir)
+        self._write('foo.sql', 'select 1;')
+        self.assertEquals(watcher.events(0), [('created', 'foo.sql')])
+        os.remove(os.path.join(self.migrations_dir, 'foo.sql'))
+        self.assertEquals(watcher.events(0), [('deleted', 'foo.sql')])
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_jsonl_sink(self):
+        path = os.path.join(self.directory, 'events.jsonl')
+        Metrics([JsonlSink(path)]).emit('script_finished', script='foo.sql', duration=1.5)
+        with open(path) as jsonl_file:
+            event = json.loads(jsonl_file.readline())
+        self.assertEquals((event['event'], event['script'], event['duration']), ('script_finished', 'foo.sql', 1.5))
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink = StatsdSink(port=server.getsockname()[1], host='127.0.0.1')
+        sink.emit('script_finished', dict(status='ok', duration=1.5, rows_affected=None))
+        self.assertEquals([server.recv(1024) for _ in range(2)], ['migratron.script.ok:1|c', 'migratron.script.duration:1500|ms'])
+
+    def test_prometheus_sink(self):
+        path = os.path.join(self.directory, 'migratron.prom')
+        sink = PrometheusTextfileSink(path)
+        sink.emit('run_started', dict(database='default', type='pre', scripts=3))
+        sink.emit('script_finished', dict(status='ok', duration=1.5, rows_affected=10))
+        with open(path) as prom_file:
+            lines = prom_file.read().splitlines()
+        self.assertTrue('migratron_scripts_ok_total{database="default",type="pre"} 1.0' in lines)
+        self.assertTrue('migratron_rows_affected_total{database="default",type="pre"} 10.0' in lines)
+        self.assertEquals(os.listdir(self.directory), ['migratron.prom'])
+
+    def test_prometheus_sink_per_database(self):
+        path = os.path.join(self.directory, 'migratron.prom')
+        for database in ('default', 'shard_1'):
+            PrometheusTextfileSink(path).emit('run_started', dict(database=database, type=None, scripts=3))
+        self.assertEquals(sorted(os.listdir(self.directory)), ['migratron.prom', 'migratron_shard_1.prom'])
+        with open(os.path.join(self.directory, 'migratron_shard_1.prom')) as prom_file:
+            self.assertTrue('migratron_run_pending_scripts{database="shard_1",type=""} 3.0' in prom_file.read())
+
+    def test_get_metrics(self):
+        path = os.path.join(self.directory, 'events.jsonl')
+        with self.settings(MIGRATIONS_METRICS=[dict(sink='jsonl', path=path), dict(sink='migratron.metrics.MetricsSink')]):
+            sinks = get_metrics().sinks
+        self.assertEquals([sink.__class__.__name__ for sink in sinks], ['JsonlSink', 'MetricsSink'])
+
+    def test_get_metrics_skips_broken_entries(self):
+        path = os.path.join(self.directory, 'events.jsonl')
+        with self.settings(MIGRATIONS_METRICS=[dict(sink='statsd', port='abc'), dict(sink='no.such.Sink'),
+                                               dict(sink='jsonl', path=path)]):
+            with patch('sys.stderr', StringIO()) as stderr:
+                sinks = get_metrics().sinks
+        self.assertEquals([sink.__class__.__name__ for sink in sinks], ['JsonlSink'])
+        self.assertEquals(stderr.getvalue().count('Skipping metrics sink'), 2)
+
+    def test_single_script_run_emits_run_events(self):
+        MigrationFactory(filename='foo.sql')
+        command = MigrateCommandFactory()
+        command.failfast_bad_type = MagicMock()
+        command.sync_if_needed = MagicMock()
+        command.run = MagicMock()
+        path = os.path.join(self.directory, 'events.jsonl')
+        with self.settings(MIGRATIONS_METRICS=[dict(sink='jsonl', path=path)]):
+            command.handle('foo.sql')
+        with open(path) as jsonl_file:
+            self.assertEquals([json.loads(line)['event'] for line in jsonl_file], ['run_started', 'run_finished'])
+        self.assertEquals(command.run.call_args, call(Migration.objects.get(filename='foo.sql')))
+        self.assertEquals(command.metrics, None)  # closed
+
+    def test_broken_sink_is_disabled(self):
+        metrics = Metrics([JsonlSink(os.path.join(self.directory, 'missing', 'events.jsonl'))])
+        with patch('sys.stderr', StringIO()):
+            metrics.emit('run_started')
+        self.assertEquals(metrics.sinks, [])
+
+
+class SqlTest(TestCase):
+
+    def test_split_statements(self):
+        self.assertEquals(split_statements("/*\nAuthor: me\n*/\nselect ';'; -- comment\nselect 1;\n"),
+            ["select ';'", 'select 1'])
+
+    def test_split_statements_dollar_quotes(self):
+        function = 'CREATE FUNCTION f() RETURNS trigger AS $$ BEGIN x := 1; RETURN NULL; END; $$ LANGUAGE plpgsql'
+        tagged = "SELECT $body$ it's; $$ fine $body$"
+        self.assertEquals(split_statements('%s;\n%s; select $1;' % (function, tagged)), [function, tagged, 'select $1'])
+
+    def test_can_run_on_connection(self):
+        self.assertTrue(can_run_on_connection('CREATE FUNCTION f() AS $$ BEGIN RETURN 1; END; $$; select 1;'))
+        self.assertFalse(can_run_on_connection('BEGIN; update foo set bar = 1; COMMIT;'))
+        self.assertFalse(can_run_on_connection('\\set ON_ERROR_STOP on\nselect 1;'))
+        self.assertFalse(can_run_on_connection('DELIMITER //\nCREATE PROCEDURE p() BEGIN select 1; END //'))
+
+    def test_timeout_statements(self):
+        self.assertEquals(timeout_statements('postgresql', 5, 60),
+            ["SET lock_timeout = '5000ms'", "SET statement_timeout = '60000ms'"])
+        self.assertEquals(timeout_statements('sqlite', None, 60), [])
+
+    def test_explain_warnings_alter_table(self):
+        self.assertEquals(explain_warnings(None, 'ALTER TABLE foo ADD COLUMN bar int;'),
+            ['ALTER TABLE foo may lock or rewrite the whole table'])
+
+    def test_explain_warnings_no_where(self):
+        warnings = explain_warnings(connection, 'UPDATE migratron_migration SET flagged = 0;')
+        self.assertTrue('"UPDATE migratron_migration SET flagged = 0" has no WHERE clause, and will touch every row' in warnings)
+
 
 class MigrateCommandTransaction(TransactionTestCase):
     ''' need to inherit from TransactionTestCase if you want to actually
@@ -250,3 +750,87 @@ class MigrateCommandTransaction(TransactionTestCase):
     def test_execute_sql_multiple_statements(self):
         ''' if you tried to do this in one cursor.execute(), it would fail in mysql '''
         MigrateCommandFactory().execute_sql('CREATE TABLE foobar (col1 int null, col2 varchar(255) null); DROP TABLE foobar;')
+
+    def test_execute_sql_statements(self):
+        command = MigrateCommandFactory()
+        self.assertTrue(command.execute_sql_statements(
+            'CREATE TABLE foobar (col1 int null); INSERT INTO foobar VALUES (1); DROP TABLE foobar;'))
+        self.assertFalse(command.execute_sql_statements('SELECT * FROM table_does_not_exist;'))
+
+
+class OnlineSchemaChangeTest(TransactionTestCase):
+
+    def setUp(self):
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE online_test (id integer PRIMARY KEY, name varchar(20) NULL)')
+        for id in range(1, 26):
+            cursor.execute('INSERT INTO online_test (id, name) VALUES (%s, %s)', [id, 'name%s' % id])
+
+    def tearDown(self):
+        cursor = connection.cursor()
+        for table in ('online_test', '_online_test_old', '_online_test_new'):
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+
+    def _rows(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, name, email FROM online_test ORDER BY id')
+        return cursor.fetchall()
+
+    def test_from_sql_only_alter_table(self):
+        with self.assertRaises(ValueError):
+            OnlineSchemaChange.from_sql(connection, 'ALTER TABLE online_test ADD COLUMN email varchar(50) NULL; DROP TABLE foo;')
+
+    def test_run(self):
+        progress = MagicMock()
+        copied = OnlineSchemaChange.from_sql(connection, 'ALTER TABLE online_test ADD COLUMN email varchar(50) NULL;',
+            batch_size=10, sleep=0, progress=progress).run()
+        self.assertEquals(copied, 25)
+        progress.assert_called_with(25, 25)
+        rows = self._rows()
+        self.assertEquals(len(rows), 25)
+        self.assertEquals(rows[0], (1, 'name1', None))
+        self.assertTrue('_online_test_old' in connection.introspection.table_names())
+
+    def test_triggers_catch_up(self):
+        change = OnlineSchemaChange.from_sql(connection, 'ALTER TABLE online_test ADD COLUMN email varchar(50) NULL;',
+            batch_size=10, sleep=0)
+        change.prepare()
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO online_test (id, name) VALUES (26, 'new')")
+        cursor.execute("UPDATE online_test SET name = 'changed' WHERE id = 1")
+        cursor.execute('DELETE FROM online_test WHERE id = 2')
+        change.copy()
+        change.swap()
+        rows = self._rows()
+        self.assertEquals([row[0] for row in rows], [1] + range(3, 27))
+        self.assertEquals(rows[0][1], 'changed')
+
+    def test_triggers_catch_up_deletes_during_copy(self):
+        cursor = connection.cursor()
+
+        def delete_rows(copied, total):  # between batches, both behind and ahead of the copy
+            cursor.execute('DELETE FROM online_test WHERE id IN (%s, %s)' % (copied, copied + 5))
+
+        OnlineSchemaChange.from_sql(connection, 'ALTER TABLE online_test ADD COLUMN email varchar(50) NULL;',
+            batch_size=10, sleep=0, progress_interval=0, progress=delete_rows).run()
+        self.assertEquals([row[0] for row in self._rows()],
+            [id for id in range(1, 26) if id not in (10, 15, 20, 23, 25)])
+
+    def test_batch_sql_locks_source_rows(self):
+        change = OnlineSchemaChange(MagicMock(vendor='postgresql'), 'online_test', [])
+        change.connection.ops.quote_name = lambda name: '"%s"' % name
+        change.pk, change.common_columns = 'id', ['id', 'name']
+        self.assertEquals(change.batch_sql(True),
+            'INSERT INTO "_online_test_new" ("id", "name") SELECT "id", "name" FROM "online_test" '
+            'WHERE "id" >= %s AND "id" < %s FOR SHARE ON CONFLICT DO NOTHING')
+        change.connection.vendor = 'mysql'
+        self.assertTrue(change.batch_sql(False).endswith('"id" <= %s LOCK IN SHARE MODE'))
+
+    def test_swap_mysql_renames_before_dropping_triggers(self):
+        change = OnlineSchemaChange(MagicMock(vendor='mysql'), 'online_test', [])
+        change.connection.ops.quote_name = lambda name: '`%s`' % name
+        change.execute = MagicMock()
+        change.swap()
+        statements = [args[0] for args, kwargs in change.execute.call_args_list]
+        self.assertTrue(statements[0].startswith('RENAME TABLE `online_test` TO `_online_test_old`'))
+        self.assertTrue(all(statement.startswith('DROP TRIGGER') for statement in statements[1:]))
@@ -0,0 +1,108 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import stat
+import struct
+import sys
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MODIFY | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; followed by a null padded name
+
+
+class InotifyWatcher(object):
+    ''' Linux inotify over ctypes, so there's nothing extra to install.
+    events() returns (kind, filename) tuples, where kind is one of
+    "created", "modified" or "deleted", or ("overflow", None) if the kernel
+    dropped events because its queue filled up. '''
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for %s' % path)
+
+    def events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(('overflow', None))
+                continue
+            if mask & IN_ISDIR or not name:
+                continue
+            if not isinstance(name, str):
+                name = name.decode(sys.getfilesystemencoding())
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                events.append(('created', name))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append(('deleted', name))
+            else:
+                events.append(('modified', name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    ''' Fallback for systems without inotify; compares directory listings
+    and stat signatures every time events() is called. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for name in os.listdir(self.path):
+            try:
+                stats = os.stat(os.path.join(self.path, name))
+            except OSError:  # deleted in the meantime
+                continue
+            if stat.S_ISREG(stats.st_mode):
+                snapshot[name] = (stats.st_mtime, stats.st_size)
+        return snapshot
+
+    def events(self, timeout):
+        time.sleep(timeout)
+        snapshot, previous = self._snapshot(), self.snapshot
+        self.snapshot = snapshot
+        events = [('deleted', name) for name in previous if name not in snapshot]
+        for name, signature in snapshot.items():
+            if name not in previous:
+                events.append(('created', name))
+            elif previous[name] != signature:
+                events.append(('modified', name))
+        return events
+
+    def close(self):
+        pass
+
+
+def get_watcher(path, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):  # not Linux, or out of inotify watches
+            pass
+    return PollingWatcher(path)